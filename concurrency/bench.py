@@ -0,0 +1,354 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+DEVICE_TYPES = ('idfa', 'gaid', 'adid', 'dvid')
+DEFAULT_CONFIGS = (
+    '--parsers 1 --serializers 0 --senders 1',
+    '--parsers 4 --serializers 0 --senders 4',
+    '--parsers 4 --serializers 2 --senders 4',
+    '--parsers 4 --serializers 0 --asyncio',
+    '--decompressors 4 --parsers 4 --serializers 0 --asyncio',
+)
+STAGE_CPU_LINE = re.compile(r'Stage CPU seconds: (.*)')
+READ_SIZE = 64 * 1024
+HERE = os.path.dirname(os.path.abspath(__file__))
+GO_SOURCE = os.path.join(HERE, os.pardir, 'golang')
+
+
+def apps_count(rnd, distribution, mean):
+    if distribution == 'fixed':
+        return mean
+    if distribution == 'uniform':
+        return rnd.randint(1, 2 * mean - 1)
+    return max(int(rnd.expovariate(1 / mean)), 1)
+
+
+def generate_file(path, lines, size, apps_mean, apps_distribution, bad_rate, seed):
+    """Write synthetic appsinstalled .tsv.gz, stop after lines lines or size uncompressed bytes, return line count"""
+    rnd = random.Random(seed)
+    written = count = 0
+    with gzip.open(path, 'wb', compresslevel=6) as fd:
+        while count < lines and written < size:
+            batch = []
+            for _ in range(min(10000, lines - count)):
+                apps = ','.join(str(rnd.randint(1, 100000)) for _ in range(apps_count(rnd, apps_distribution, apps_mean)))
+                if rnd.random() < bad_rate:
+                    apps += ',x'
+                batch.append('{}\t{:032x}\t{:.6f}\t{:.6f}\t{}\n'.format(
+                    rnd.choice(DEVICE_TYPES), rnd.getrandbits(128),
+                    rnd.uniform(-90, 90), rnd.uniform(-180, 180), apps
+                ))
+            data = ''.join(batch).encode()
+            fd.write(data)
+            written += len(data)
+            count += len(batch)
+    return count
+
+
+class FakeMemcached:
+    """Memcached text protocol stand-in, replies to every read after latency seconds
+
+    set/add/replace fail with SERVER_ERROR with error_rate probability. Values are kept only with store=True.
+    """
+
+    def __init__(self, latency=0, error_rate=0, store=False, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.store = store
+        self.random = random.Random(seed)
+        self.data = {}
+        self.sets = 0
+        self.errors = 0
+        self.connections = set()
+
+    def reset(self):
+        self.data.clear()
+        self.sets = self.errors = 0
+
+    async def handle(self, reader, writer):
+        buffer = b''
+        self.connections.add(writer)
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                buffer += data
+                replies, buffer, close = self.execute(buffer)
+                if replies:
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    writer.write(b''.join(replies))
+                    await writer.drain()
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    def execute(self, buffer):
+        """Run every complete command in buffer, return (replies, unconsumed buffer, close connection)"""
+        replies = []
+        pos = 0
+        while True:
+            line_end = buffer.find(b'\r\n', pos)
+            if line_end < 0:
+                break
+            parts = buffer[pos:line_end].split()
+            command = parts[0] if parts else b''
+            if command in (b'set', b'add', b'replace'):
+                value_end = line_end + 2 + int(parts[4])
+                if len(buffer) < value_end + 2:
+                    break
+                reply = self.set(parts[1], buffer[line_end + 2:value_end])
+                if parts[-1] != b'noreply':
+                    replies.append(reply)
+                pos = value_end + 2
+                continue
+            pos = line_end + 2
+            if command in (b'get', b'gets'):
+                for key in parts[1:]:
+                    if key in self.data:
+                        value = self.data[key]
+                        replies.append(b'VALUE %s 0 %d\r\n%s\r\n' % (key, len(value), value))
+                replies.append(b'END\r\n')
+            elif command == b'delete':
+                replies.append(b'DELETED\r\n' if self.data.pop(parts[1], None) is not None else b'NOT_FOUND\r\n')
+            elif command == b'flush_all':
+                self.data.clear()
+                replies.append(b'OK\r\n')
+            elif command == b'version':
+                replies.append(b'VERSION fake\r\n')
+            elif command == b'quit':
+                return replies, b'', True
+            else:
+                replies.append(b'ERROR\r\n')
+        return replies, buffer[pos:], False
+
+    def set(self, key, value):
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return b'SERVER_ERROR out of memory storing object\r\n'
+        self.sets += 1
+        if self.store:
+            self.data[key] = value
+        return b'STORED\r\n'
+
+
+class FakeCluster:
+    """One FakeMemcached per device type, served from an event loop in a background thread"""
+
+    def __init__(self, latency=0, error_rate=0, store=False):
+        self.servers = {
+            dev_type: FakeMemcached(latency, error_rate, store, seed=n) for n, dev_type in enumerate(DEVICE_TYPES)
+        }
+        self.addresses = {}
+        self.listeners = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        for dev_type, server in self.servers.items():
+            listener = asyncio.run_coroutine_threadsafe(
+                asyncio.start_server(server.handle, '127.0.0.1', 0), self.loop
+            ).result()
+            self.listeners.append(listener)
+            self.addresses[dev_type] = '127.0.0.1:{}'.format(listener.sockets[0].getsockname()[1])
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def shutdown(self):
+        for listener in self.listeners:
+            listener.close()
+        for server in self.servers.values():
+            for writer in list(server.connections):
+                writer.transport.abort()
+        # Handlers may still sleep on latency before a reply
+        handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        for listener in self.listeners:
+            await listener.wait_closed()
+
+    def reset(self):
+        for server in self.servers.values():
+            server.reset()
+
+    @property
+    def sets(self):
+        return sum(server.sets for server in self.servers.values())
+
+    @property
+    def errors(self):
+        return sum(server.errors for server in self.servers.values())
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_loader(name, args, source, lines, cluster, log_path=None):
+    """Run one loader process on a fresh link of source, return its throughput report"""
+    run_dir = tempfile.mkdtemp(prefix='memc-bench-run-')
+    try:
+        os.link(source, os.path.join(run_dir, 'appsinstalled.tsv.gz'))
+    except OSError:
+        shutil.copy(source, os.path.join(run_dir, 'appsinstalled.tsv.gz'))
+    cluster.reset()
+    cpu_before = children_cpu()
+    started = time.monotonic()
+    try:
+        subprocess.run(args(os.path.join(run_dir, '*.tsv.gz')), check=True, cwd=HERE)
+    finally:
+        shutil.rmtree(run_dir)
+    elapsed = time.monotonic() - started
+    result = {
+        'name': name,
+        'elapsed': round(elapsed, 3),
+        'lines_per_second': round(lines / elapsed, 1),
+        'sets_per_second': round(cluster.sets / elapsed, 1),
+        'sets': cluster.sets,
+        'server_errors': cluster.errors,
+        'cpu_seconds': round(children_cpu() - cpu_before, 3),
+    }
+    if log_path is not None:
+        result['stage_cpu_seconds'] = read_stage_cpu(log_path)
+    return result
+
+
+def read_stage_cpu(log_path):
+    stage_cpu = {}
+    with open(log_path) as fd:
+        for line in fd:
+            match = STAGE_CPU_LINE.search(line)
+            if match:
+                for item in match.group(1).split():
+                    stage, cpu = item.split('=')
+                    stage_cpu[stage] = round(stage_cpu.get(stage, 0) + float(cpu), 3)
+    return stage_cpu
+
+
+def python_loader(config, addresses, log_path):
+    def args(pattern):
+        open(log_path, 'w').close()
+        command = [sys.executable, os.path.join(HERE, 'memc_load.py'), '--pattern', pattern, '--log', log_path]
+        for dev_type, address in addresses.items():
+            command += ['--' + dev_type, address]
+        return command + config.split()
+    return args
+
+
+def build_go_loader(build_dir):
+    """Build golang/memc_load when a Go toolchain is present, return binary path or None"""
+    go = shutil.which('go')
+    if go is None:
+        logging.info('Go toolchain not found, skipping Go comparison')
+        return None
+    binary = os.path.join(build_dir, 'memc_load_go')
+    try:
+        subprocess.run([go, 'build', '-o', binary, './memc_load'], check=True, cwd=GO_SOURCE)
+    except subprocess.CalledProcessError as e:
+        logging.error('Cannot build Go memc_load: {}'.format(e))
+        return None
+    return binary
+
+
+def go_loader(binary, workers, addresses, log_path):
+    def args(pattern):
+        command = [binary, '-pattern', pattern, '-log', log_path, '-workers', str(workers)]
+        for dev_type, address in addresses.items():
+            command += ['-' + dev_type, address]
+        return command
+    return args
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp(prefix='memc-bench-')
+    cluster = FakeCluster(args.latency, args.error_rate)
+    cluster.start()
+    try:
+        source = args.input
+        if source is None:
+            source = os.path.join(work_dir, 'appsinstalled.tsv.gz')
+            logging.info('Generating {}'.format(source))
+            lines = generate_file(source, args.lines, args.size * 1024 * 1024, args.apps_mean, args.apps_distribution,
+                                  args.bad_rate, args.seed)
+        else:
+            with gzip.open(source) as fd:
+                lines = sum(1 for _ in fd)
+        report = {
+            'input': {
+                'lines': lines, 'compressed_bytes': os.path.getsize(source),
+                'apps_mean': args.apps_mean, 'apps_distribution': args.apps_distribution,
+            },
+            'memcached': {'latency': args.latency, 'error_rate': args.error_rate},
+            'results': [],
+        }
+
+        log_path = os.path.join(work_dir, 'memc_load.log')
+        runs = [(config, python_loader(config, cluster.addresses, log_path), log_path) for config in args.configs]
+        binary = build_go_loader(work_dir) if not args.no_go else None
+        if binary is not None:
+            runs.append(('go -workers {}'.format(args.go_workers),
+                         go_loader(binary, args.go_workers, cluster.addresses, os.devnull), None))
+
+        for name, loader, loader_log in runs:
+            logging.info('Run {}'.format(name))
+            result = run_loader(name, loader, source, lines, cluster, loader_log)
+            report['results'].append(result)
+            logging.info('{lines_per_second} lines/s, {sets_per_second} sets/s, cpu {cpu_seconds}s'.format(**result))
+    finally:
+        cluster.stop()
+        shutil.rmtree(work_dir)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='memc_load throughput benchmark against local fake memcached servers')
+    parser.add_argument('--input', default=None, help='existing .tsv.gz file instead of a generated one')
+    parser.add_argument('--lines', type=int, default=500000, help='lines to generate')
+    parser.add_argument('--size', type=int, default=1024, help='max uncompressed MB to generate')
+    parser.add_argument('--apps-mean', type=int, default=50, help='mean number of apps per line')
+    parser.add_argument('--apps-distribution', choices=('fixed', 'uniform', 'exponential'), default='exponential')
+    parser.add_argument('--bad-rate', type=float, default=0.001, help='share of lines with a malformed app id')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0, help='fake memcached reply delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of sets answered with SERVER_ERROR')
+    parser.add_argument('--configs', default=';'.join(DEFAULT_CONFIGS),
+                        help='memc_load argument sets separated by ";"')
+    parser.add_argument('--go-workers', type=int, default=5)
+    parser.add_argument('--no-go', action='store_true', help='skip Go implementation even if go is installed')
+    parser.add_argument('--output', default=None, help='write JSON report to file instead of stdout')
+    args = parser.parse_args()
+    args.configs = [config.strip() for config in args.configs.split(';') if config.strip()]
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    main(args)
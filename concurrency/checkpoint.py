@@ -0,0 +1,110 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+
+def state_path(path):
+    head, fn = os.path.split(path)
+    return os.path.join(head, f'.{fn}.progress')
+
+
+def remove(path):
+    try:
+        os.remove(state_path(path))
+    except FileNotFoundError:
+        pass
+
+
+class Progress:
+    """Track which chunks of a file were acknowledged by memcached and checkpoint them to a state file
+
+    Chunk is (start, end, lines): uncompressed byte range of whole lines and the number of lines in it.
+    It is acknowledged once every record parsed from it was stored by memcached. A chunk with a record
+    that was not stored never becomes acknowledged, so a restart sends it again. Acknowledged
+    ranges are merged and flushed atomically at most every interval seconds, so a restart resumes
+    from the last flushed state and may push a few batches twice, never skip one.
+    With path None nothing is loaded or saved.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.done = []
+        self.lines = 0
+        self.pending = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.saved_at = time.monotonic()
+        if path is not None:
+            self.load()
+
+    def load(self):
+        stat = os.stat(self.path)
+        try:
+            with open(state_path(self.path)) as fd:
+                state = json.load(fd)
+        except (OSError, ValueError):
+            return
+        if (state['size'], state['mtime']) != (stat.st_size, stat.st_mtime_ns):
+            return
+        self.done = [tuple(interval) for interval in state['done']]
+        self.lines = state['lines']
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        stat = os.stat(self.path)
+        state = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'done': self.done, 'lines': self.lines}
+        self.saved_at = time.monotonic()
+        tmp_path = state_path(self.path) + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump(state, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_path, state_path(self.path))
+
+    def start(self, chunk, records):
+        """Register chunk with number of records that have to be sent before it is acknowledged"""
+        with self.lock:
+            if records:
+                self.pending[chunk] = self.pending.get(chunk, 0) + records
+                return
+            self._ack(chunk)
+            self._maybe_save()
+
+    def sent(self, chunks, failed=()):
+        """Mark one record sent per item of chunks, chunks in failed lost a record and are not acknowledged"""
+        with self.lock:
+            self.failed.update(failed)
+            for chunk in chunks:
+                self.pending[chunk] -= 1
+                if not self.pending[chunk]:
+                    del self.pending[chunk]
+                    if chunk in self.failed:
+                        self.failed.discard(chunk)
+                    else:
+                        self._ack(chunk)
+            self._maybe_save()
+
+    def _ack(self, chunk):
+        start, end, lines = chunk
+        self.lines += lines
+        i = bisect.bisect_left(self.done, (start, end))
+        if i and self.done[i - 1][1] >= start:
+            i -= 1
+            start = self.done[i][0]
+        j = i
+        while j < len(self.done) and self.done[j][0] <= end:
+            end = max(end, self.done[j][1])
+            j += 1
+        self.done[i:j] = [(start, end)]
+
+    def _maybe_save(self):
+        if self.path is not None and time.monotonic() - self.saved_at >= self.interval:
+            self._save()
@@ -0,0 +1,257 @@
+import collections
+import ctypes
+import ctypes.util
+import os
+import pickle
+import zlib
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+WINDOW_SIZE = 32 * 1024
+READ_SIZE = 256 * 1024
+INDEX_VERSION = 1
+
+Point = collections.namedtuple('Point', ['out', 'inp', 'bits', 'window'])
+Index = collections.namedtuple('Index', ['size', 'mtime', 'length', 'points'])
+
+
+class GzipIndexError(Exception):
+    pass
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+def load_zlib():
+    path = ctypes.util.find_library('z')
+    if path is None:
+        return None
+    lib = ctypes.CDLL(path)
+    lib.zlibVersion.restype = ctypes.c_char_p
+    stream_p = ctypes.POINTER(ZStream)
+    lib.inflateInit2_.argtypes = [stream_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    lib.inflate.argtypes = [stream_p, ctypes.c_int]
+    lib.inflateEnd.argtypes = [stream_p]
+    lib.inflateReset.argtypes = [stream_p]
+    lib.inflateReset2.argtypes = [stream_p, ctypes.c_int]
+    lib.inflatePrime.argtypes = [stream_p, ctypes.c_int, ctypes.c_int]
+    lib.inflateSetDictionary.argtypes = [stream_p, ctypes.c_char_p, ctypes.c_uint]
+    return lib
+
+
+libz = load_zlib()
+
+
+def available():
+    return libz is not None
+
+
+class Inflater:
+    """Thin wrapper over zlib inflate that exposes block boundaries and bit-level priming
+
+    Python's zlib module hides both, and they are what a random-access index needs.
+    """
+
+    def __init__(self, fd, wbits):
+        self.fd = fd
+        self.stream = ZStream()
+        self.inbuf = ctypes.create_string_buffer(READ_SIZE)
+        self.outbuf = ctypes.create_string_buffer(READ_SIZE)
+        self.eof = False
+        version = libz.zlibVersion()
+        if libz.inflateInit2_(ctypes.byref(self.stream), wbits, version, ctypes.sizeof(ZStream)) != Z_OK:
+            raise GzipIndexError('inflateInit2 failed')
+
+    def close(self):
+        if self.stream is not None:
+            libz.inflateEnd(ctypes.byref(self.stream))
+            self.stream = None
+
+    def prime(self, bits, value):
+        if libz.inflatePrime(ctypes.byref(self.stream), bits, value) != Z_OK:
+            raise GzipIndexError('inflatePrime failed')
+
+    def set_dictionary(self, window):
+        if libz.inflateSetDictionary(ctypes.byref(self.stream), window, len(window)) != Z_OK:
+            raise GzipIndexError('inflateSetDictionary failed')
+
+    def reset(self, wbits=None):
+        if wbits is None:
+            libz.inflateReset(ctypes.byref(self.stream))
+        else:
+            libz.inflateReset2(ctypes.byref(self.stream), wbits)
+
+    @property
+    def pending_input(self):
+        return self.stream.avail_in
+
+    @property
+    def data_type(self):
+        return self.stream.data_type
+
+    def skip_input(self, count):
+        """Drop count bytes of compressed input, used to step over a raw member's trailer"""
+        while count:
+            if not self.stream.avail_in and not self.fill():
+                return
+            step = min(count, self.stream.avail_in)
+            self.stream.next_in += step
+            self.stream.avail_in -= step
+            count -= step
+
+    def fill(self):
+        n = self.fd.readinto(self.inbuf)
+        if not n:
+            self.eof = True
+            return 0
+        self.stream.next_in = ctypes.addressof(self.inbuf)
+        self.stream.avail_in = n
+        return n
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        """Run one inflate call, return (status, output bytes)"""
+        if not self.stream.avail_in and not self.eof:
+            self.fill()
+        self.stream.next_out = ctypes.addressof(self.outbuf)
+        self.stream.avail_out = READ_SIZE
+        status = libz.inflate(ctypes.byref(self.stream), flush)
+        produced = READ_SIZE - self.stream.avail_out
+        if status == Z_BUF_ERROR and self.eof:
+            raise GzipIndexError('Unexpected end of compressed data')
+        if status == Z_NEED_DICT or status < 0 and status != Z_BUF_ERROR:
+            raise GzipIndexError(f'inflate failed with {status}: {self.stream.msg}')
+        return status, ctypes.string_at(self.outbuf, produced)
+
+
+def build_index(path, span):
+    """Decompress file once and record an inflate restart point about every span bytes of output"""
+    points = []
+    window = b''
+    out = last = 0
+    with open(path, 'rb') as fd:
+        inflater = Inflater(fd, 47)
+        try:
+            while True:
+                status, data = inflater.inflate(Z_BLOCK)
+                if data:
+                    out += len(data)
+                    window = (window + data)[-WINDOW_SIZE:]
+                data_type = inflater.data_type
+                if data_type & 128 and not data_type & 64 and (not points or out - last > span):
+                    inp = fd.tell() - inflater.pending_input
+                    points.append(Point(out, inp, data_type & 7, zlib.compress(window)))
+                    last = out
+                if status == Z_STREAM_END:
+                    if not inflater.pending_input and not inflater.fill():
+                        break
+                    inflater.reset()
+        finally:
+            inflater.close()
+    stat = os.stat(path)
+    return Index(stat.st_size, stat.st_mtime_ns, out, points)
+
+
+def index_path(path):
+    head, fn = os.path.split(path)
+    return os.path.join(head, f'.{fn}.gzidx')
+
+
+def save_index(path, index):
+    tmp_path = index_path(path) + '.tmp'
+    with open(tmp_path, 'wb') as fd:
+        pickle.dump((INDEX_VERSION, index), fd, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path(path))
+
+
+def load_index(path):
+    """Return cached index for path, or None if there is none or the file changed since it was built"""
+    try:
+        with open(index_path(path), 'rb') as fd:
+            version, index = pickle.load(fd)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    stat = os.stat(path)
+    if version != INDEX_VERSION or (index.size, index.mtime) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return index
+
+
+def get_index(path, span):
+    index = load_index(path)
+    if index is None:
+        index = build_index(path, span)
+        save_index(path, index)
+    return index
+
+
+def remove_index(path):
+    try:
+        os.remove(index_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def split_index(index, count):
+    """Pick up to count points that cut the uncompressed stream into ranges of similar length
+
+    Returns list of (point, end) pairs, end is the uncompressed offset where the next range starts.
+    """
+    starts = []
+    for n in range(count):
+        target = index.length * n // count
+        point = min(index.points, key=lambda p: abs(p.out - target))
+        if not starts or point.out > starts[-1].out:
+            starts.append(point)
+    ends = [point.out for point in starts[1:]] + [index.length]
+    return list(zip(starts, ends))
+
+
+def extract(path, point):
+    """Yield decompressed data from point to the end of file"""
+    with open(path, 'rb') as fd:
+        fd.seek(point.inp - (1 if point.bits else 0))
+        inflater = Inflater(fd, -15)
+        raw = True
+        try:
+            if point.bits:
+                inflater.prime(point.bits, fd.read(1)[0] >> (8 - point.bits))
+            window = zlib.decompress(point.window)
+            if window:
+                inflater.set_dictionary(window)
+            while True:
+                status, data = inflater.inflate()
+                if data:
+                    yield data
+                if status == Z_STREAM_END:
+                    if raw:
+                        # Raw stream stops before the member trailer, next members are parsed as gzip
+                        inflater.skip_input(8)
+                        inflater.reset(31)
+                        raw = False
+                    else:
+                        inflater.reset()
+                    if not inflater.pending_input and not inflater.fill():
+                        return
+        finally:
+            inflater.close()
@@ -0,0 +1,129 @@
+import asyncio
+import collections
+import re
+
+
+class MemcacheConnection:
+    """Memcached text protocol connection with pipelined batches of set commands
+
+    Batches are written back to back without waiting for replies, replies are matched
+    to batches in order by a single reader task.
+    """
+    READ_SIZE = 64 * 1024
+    MAX_KEY_LENGTH = 250
+    INVALID_KEY = re.compile(rb'[\x00-\x20\x7f]')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = collections.deque()
+        self.closed = False
+        self.reader_task = asyncio.get_running_loop().create_task(self._read_replies())
+
+    @classmethod
+    async def open(cls, address, timeout):
+        host, port = address.rsplit(':', 1)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), timeout)
+        return cls(reader, writer)
+
+    @property
+    def in_flight(self):
+        return len(self.pending)
+
+    async def set_multi(self, batch):
+        """Send key -> value batch in one write, return list of keys that were not stored"""
+        if self.closed:
+            return list(batch)
+        keys, invalid, commands = [], [], []
+        for key, value in batch.items():
+            raw_key = key.encode()
+            if len(raw_key) > self.MAX_KEY_LENGTH or self.INVALID_KEY.search(raw_key):
+                invalid.append(key)
+                continue
+            keys.append(key)
+            commands.append(b'set %s 0 0 %d\r\n%s\r\n' % (raw_key, len(value), value))
+        if not keys:
+            return invalid
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((keys, future))
+        self.writer.write(b''.join(commands))
+        try:
+            await self.writer.drain()
+        except OSError:
+            self.close()
+        return invalid + await future
+
+    async def _read_replies(self):
+        buffer = b''
+        try:
+            while True:
+                data = await self.reader.read(self.READ_SIZE)
+                if not data:
+                    break
+                buffer += data
+                while self.pending:
+                    keys, future = self.pending[0]
+                    lines = buffer.split(b'\r\n', len(keys))
+                    if len(lines) <= len(keys):
+                        break
+                    buffer = lines.pop()
+                    self.pending.popleft()
+                    if not future.done():
+                        future.set_result([key for key, line in zip(keys, lines) if line != b'STORED'])
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        while self.pending:
+            keys, future = self.pending.popleft()
+            if not future.done():
+                future.set_result(keys)
+        self.writer.close()
+        if self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()
+
+
+class MemcacheWriter:
+    """Pool of pipelined connections per memcached address with a window of batches in flight"""
+
+    def __init__(self, connections=2, window=32, timeout=3):
+        self.connections = connections
+        self.timeout = timeout
+        self.window = asyncio.Semaphore(window)
+        self.pools = collections.defaultdict(list)
+        self.locks = collections.defaultdict(asyncio.Lock)
+
+    async def _connection(self, address):
+        async with self.locks[address]:
+            pool = self.pools[address]
+            pool[:] = [conn for conn in pool if not conn.closed]
+            if len(pool) < self.connections:
+                conn = await MemcacheConnection.open(address, self.timeout)
+                pool.append(conn)
+                return conn
+            return min(pool, key=lambda conn: conn.in_flight)
+
+    async def set_multi(self, address, batch):
+        """Write batch to address, return list of keys that were not stored"""
+        async with self.window:
+            try:
+                conn = await self._connection(address)
+            except (OSError, asyncio.TimeoutError):
+                return list(batch)
+            try:
+                return await asyncio.wait_for(conn.set_multi(batch), self.timeout)
+            except asyncio.TimeoutError:
+                conn.close()
+                return list(batch)
+
+    async def close(self):
+        for pool in self.pools.values():
+            for conn in pool:
+                conn.close()
+                await asyncio.gather(conn.reader_task, return_exceptions=True)
+        self.pools.clear()
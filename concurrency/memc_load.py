@@ -1,29 +1,54 @@
+import array
+import asyncio
 import collections
 import glob
 import gzip
 import logging
 import multiprocessing
 import os
+import queue
+import random
+import re
 import sys
 import threading
 import time
+import zlib
 from functools import partial
 from optparse import OptionParser
 
-import Queue
 import memcache
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import appsinstalled_pb2
+import checkpoint
+import gzindex
+import memc_async
 
 NORMAL_ERR_RATE = 0.01
-AppsInstalled = collections.namedtuple('AppsInstalled', ['dev_type', 'dev_id', 'lat', 'lon', 'apps'])
+MAX_APP_ID = 2 ** 32 - 1
+# Plain decimal ids, at most 10 digits so numpy can parse them as uint64 without wrapping
+APPS_PATTERN = re.compile(rb'\d{1,10}(?:,\d{1,10})*\s*')
 config = {
     'MEMC_MAX_RETRIES': 1,
     'MEMC_TIMEOUT': 3,
-    'MAX_JOB_QUEUE_SIZE': 0,
-    'MAX_RESULT_QUEUE_SIZE': 0,
-    'THREADS_PER_WORKER': 4,
-    'MEMC_BACKOFF_FACTOR': 0.3
+    'MAX_STAGE_QUEUE_SIZE': 16,
+    'PARSE_PROCESSES': max(multiprocessing.cpu_count() // 2, 1),
+    'SERIALIZE_PROCESSES': max(multiprocessing.cpu_count() // 2, 1),
+    'SEND_THREADS': 4,
+    'MEMC_BACKOFF_FACTOR': 0.3,
+    'MEMC_BATCH_SIZE': 100,
+    'MEMC_BATCH_TIMEOUT': 0.5,
+    'SEND_POLL_INTERVAL': 1,
+    'MEMC_CONNECTIONS': 2,
+    'MEMC_WINDOW': 32,
+    'CHUNK_SIZE': 256 * 1024,
+    'DECOMPRESS_PROCESSES': 1,
+    'GZIP_INDEX_SPAN': 16 * 1024 * 1024,
+    'CHECKPOINT_INTERVAL': 10,
 }
 
 
@@ -33,126 +58,504 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, '.' + fn))
 
 
-def insert_appsinstalled(memc_pool, memc_addr, appsinstalled, dry_run=False):
+def serialize_appsinstalled(appsinstalled):
+    dev_type, dev_id, lat, lon, apps = appsinstalled
     ua = appsinstalled_pb2.UserApps()
-    ua.lat = appsinstalled.lat
-    ua.lon = appsinstalled.lon
-    key = f'{appsinstalled.dev_type}:{appsinstalled.dev_id}'
-    ua.apps.extend(appsinstalled.apps)
-    packed = ua.SerializeToString()
+    if lat is not None:
+        ua.lat = lat
+        ua.lon = lon
+    # Protobuf takes Python ints much faster than numpy scalars
+    ua.apps.extend(apps.tolist())
+    key = f'{dev_type}:{dev_id}'
+    return key, ua
+
+
+def insert_appsinstalled(memc, memc_addr, batch):
+    """Write key -> packed batch with one set_multi, return list of keys that were not stored"""
+    failed = list(batch)
+    server = memc.servers[0]
     try:
-        if dry_run:
-            logging.debug('{} - {} -> {}'.format(memc_addr, key, str(ua).replace('\n', ' ')))
-        else:
-            try:
-                memc = memc_pool.get(timeout=0.1)
-            except Queue.Empty:
-                memc = memcache.Client([memc_addr], socket_timeout=config['MEMC_TIMEOUT'])
-            ok = False
-            for n in range(config['MEMC_MAX_RETRIES']):
-                ok = memc.set(key, packed)
-                if ok:
-                    break
-                backoff_value = config['MEMC_BACKOFF_FACTOR'] * (2 ** n)
-                time.sleep(backoff_value)
-            memc_pool.put(memc)
-            return ok
+        for delay in retry_delays():
+            time.sleep(delay)
+            dead_until = server.deaduntil
+            attempt = failed
+            failed = memc.set_multi({key: batch[key] for key in attempt})
+            if server.deaduntil > dead_until:
+                # set_multi swallows a reply timeout and leaves keys it did not read a reply for out of failed
+                failed = attempt
+            if not failed:
+                break
     except Exception as e:
         logging.exception(f'Cannot write to memc {memc_addr}: {e}')
-        return False
-    return True
+    return failed
+
+
+def parse_apps_array(raw_apps):
+    if not APPS_PATTERN.fullmatch(raw_apps):
+        raise ValueError(f'Invalid apps: {raw_apps}')
+    try:
+        return array.array('I', map(int, raw_apps.split(b',')))
+    except OverflowError:
+        raise ValueError(f'Invalid apps: {raw_apps}')
+
+
+def parse_apps_numpy(raw_apps):
+    if not APPS_PATTERN.fullmatch(raw_apps):
+        raise ValueError(f'Invalid apps: {raw_apps}')
+    apps = numpy.fromstring(raw_apps, dtype=numpy.uint64, sep=',')
+    if len(apps) != raw_apps.count(b',') + 1 or apps.max() > MAX_APP_ID:
+        raise ValueError(f'Invalid apps: {raw_apps}')
+    return apps.astype(numpy.uint32)
+
+
+parse_apps = parse_apps_numpy if numpy is not None else parse_apps_array
+
 
+def parse_appsinstalled(line, parse_apps=parse_apps):
+    """Parse raw line into (dev_type, dev_id, lat, lon, apps) tuple
 
-def parse_appsinstalled(line):
-    line_parts = line.strip().split('\t')
-    if len(line_parts) < 5:
+    Raises ValueError for any line that is not perfectly formed, such lines go to parse_appsinstalled_slow.
+    """
+    dev_type, dev_id, lat, lon, raw_apps = line.split(b'\t')
+    if not dev_type or not dev_id:
+        raise ValueError('Empty device')
+    return dev_type.decode(), dev_id.decode(), float(lat), float(lon), parse_apps(raw_apps)
+
+
+def parse_appsinstalled_slow(line):
+    """Parse line field by field: keep valid apps, drop invalid coords, return None if line is unusable"""
+    line_parts = line.decode(errors='replace').strip().split('\t')
+    if len(line_parts) != 5:
         return
     dev_type, dev_id, lat, lon, raw_apps = line_parts
     if not dev_type or not dev_id:
         return
-    try:
-        apps = [int(a.strip()) for a in raw_apps.split(',')]
-    except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(',') if a.isidigit()]
+    apps = array.array('I')
+    for app in raw_apps.split(','):
+        app = app.strip()
+        if app.isascii() and app.isdigit() and int(app) <= MAX_APP_ID:
+            apps.append(int(app))
+    if len(apps) != raw_apps.count(',') + 1:
         logging.info(f'Not all user apps are digits: {line}')
     try:
         lat, lon = float(lat), float(lon)
     except ValueError:
         logging.info(f'Invalid geo coords: {line}')
-    return AppsInstalled(dev_type, dev_id, lat, lon, apps)
+        lat = lon = None
+    return dev_type, dev_id, lat, lon, apps
+
+
+def put_chunk(parse_queue, start, data, done):
+    """Put data that starts at uncompressed offset start as (chunk, data) pieces, leaving out done ranges"""
+    end = start + len(data)
+    pos = start
+    pieces = []
+    for done_start, done_end in done:
+        if done_end <= pos:
+            continue
+        if done_start >= end:
+            break
+        if done_start > pos:
+            pieces.append((pos, done_start))
+        pos = done_end
+    if pos < end:
+        pieces.append((pos, end))
+    for piece_start, piece_end in pieces:
+        piece = data[piece_start - start:piece_end - start]
+        lines = piece.count(b'\n') + (not piece.endswith(b'\n'))
+        parse_queue.put(((piece_start, piece_end, lines), piece))
+
+
+def handle_decompress(fn, parse_queue, done=()):
+    """Read gzip file and cut it into chunks of whole lines"""
+    tail = b''
+    pos = 0
+    with gzip.open(fn) as fd:
+        while True:
+            data = fd.read(config['CHUNK_SIZE'])
+            if not data:
+                break
+            data = tail + data
+            cut = data.rfind(b'\n') + 1
+            tail = data[cut:]
+            if cut:
+                put_chunk(parse_queue, pos, data[:cut], done)
+                pos += cut
+    if tail:
+        put_chunk(parse_queue, pos, tail, done)
+
+
+def handle_decompress_range(fn, point, end, parse_queue, done=()):
+    """Decompress file from index point and cut it into chunks of the lines that start before end
+
+    A line that crosses a range boundary belongs to the range where it starts.
+    """
+    pos = point.out
+    started = not pos or zlib.decompress(point.window).endswith(b'\n')
+    tail = b''
+    for data in gzindex.extract(fn, point):
+        data = tail + data
+        tail = b''
+        if not started:
+            cut = data.find(b'\n') + 1
+            pos += cut or len(data)
+            if not cut:
+                continue
+            data = data[cut:]
+            started = True
+        if pos >= end:
+            return
+        if pos + len(data) >= end:
+            stop = data.find(b'\n', end - pos - 1) + 1
+            if stop:
+                put_chunk(parse_queue, pos, data[:stop], done)
+                return
+        cut = data.rfind(b'\n') + 1
+        tail = data[cut:]
+        if cut:
+            put_chunk(parse_queue, pos, data[:cut], done)
+            pos += cut
+    if tail and pos < end:
+        put_chunk(parse_queue, pos, tail, done)
+
+
+def start_decompress(fn, count, parse_queue, done, cpu_queue=None):
+    """Start one decompressor, or count of them on ranges of a gzip index when file is big enough to split"""
+    if count > 1 and gzindex.available():
+        index = gzindex.get_index(fn, config['GZIP_INDEX_SPAN'])
+        ranges = gzindex.split_index(index, count)
+        if len(ranges) > 1:
+            logging.info(f'Decompressing {fn} in {len(ranges)} ranges')
+            return [worker for point, end in ranges
+                    for worker in start_stage(handle_decompress_range, 1, fn, point, end, parse_queue, done,
+                                              cpu_queue=cpu_queue, stage='decompress')]
+    return start_stage(handle_decompress, 1, fn, parse_queue, done, cpu_queue=cpu_queue, stage='decompress')
+
+
+def handle_parse(parse_queue, output_queue, result_queue, device_memc, serialize=False, dry_run=False):
+    errors = slow = 0
+    while True:
+        item = parse_queue.get()
+        if item is None:
+            result_queue.put((0, errors, slow))
+            return
+        chunk, data = item
+
+        records = []
+        for line in data.split(b'\n'):
+            try:
+                appsinstalled = parse_appsinstalled(line)
+            except ValueError:
+                if not line.strip():
+                    continue
+                slow += 1
+                appsinstalled = parse_appsinstalled_slow(line)
+                if not appsinstalled:
+                    errors += 1
+                    continue
+
+            memc_addr = device_memc.get(appsinstalled[0])
+            if not memc_addr:
+                errors += 1
+                logging.error(f'Unknow device type: {appsinstalled[0]}')
+                continue
+
+            records.append((memc_addr, appsinstalled))
+
+        if serialize:
+            records = serialize_records(records, dry_run)
+        output_queue.put((chunk, records))
 
 
-def handle_task(job_queue, result_queue):
-    processed = errors = 0
+def serialize_records(records, dry_run=False):
+    packed = []
+    for memc_addr, appsinstalled in records:
+        key, ua = serialize_appsinstalled(appsinstalled)
+        if dry_run:
+            logging.debug('{} - {} -> {}'.format(memc_addr, key, str(ua).replace('\n', ' ')))
+        packed.append((memc_addr, key, ua.SerializeToString()))
+    return packed
+
+
+def handle_serialize(serialize_queue, send_queue, dry_run=False):
     while True:
-        try:
-            task = job_queue.get(timeout=0.1)
-        except Queue.Empty:
-            result_queue.put((processed, errors))
+        item = serialize_queue.get()
+        if item is None:
             return
+        chunk, records = item
+        send_queue.put((chunk, serialize_records(records, dry_run)))
+
+
+class Batcher:
+    """Group packed records per memcached address and account for what was written
+
+    A batch is ready once it holds MEMC_BATCH_SIZE keys or its first key waited MEMC_BATCH_TIMEOUT.
+    Ready batches are (memc_addr, batch, chunks), chunks is a list of (key, chunk) for every record,
+    written() takes them back with the keys that were not stored.
+    """
+
+    def __init__(self, progress, dry_run=False):
+        self.progress = progress
+        self.dry_run = dry_run
+        self.batches = collections.defaultdict(dict)
+        self.batch_chunks = collections.defaultdict(list)
+        self.deadlines = {}
+        self.processed = self.errors = 0
+
+    def timeout(self):
+        """Seconds until the oldest batch is due, None if there are no batches"""
+        return max(min(self.deadlines.values()) - time.monotonic(), 0) if self.deadlines else None
+
+    def add(self, chunk, records):
+        """Add (memc_addr, key, packed) records of chunk, return list of batches that are ready"""
+        if self.dry_run:
+            self.processed += len(records)
+            return []
+        if chunk is not None:
+            self.progress.start(chunk, len(records))
+        ready = []
+        for memc_addr, key, packed in records:
+            batch = self.batches[memc_addr]
+            batch[key] = packed
+            self.batch_chunks[memc_addr].append((key, chunk))
+            if len(batch) == 1:
+                self.deadlines[memc_addr] = time.monotonic() + config['MEMC_BATCH_TIMEOUT']
+            if len(batch) >= config['MEMC_BATCH_SIZE']:
+                ready.append(self._pop(memc_addr))
+        now = time.monotonic()
+        for memc_addr, deadline in list(self.deadlines.items()):
+            if deadline <= now:
+                ready.append(self._pop(memc_addr))
+        return ready
+
+    def drain(self):
+        """Return all batches, ready or not"""
+        return [self._pop(memc_addr) for memc_addr in list(self.batches)]
+
+    def written(self, batch, chunks, failed):
+        """Count a written batch, chunks with a key that was not stored stay unacknowledged"""
+        failed = set(failed)
+        self.processed += len(batch) - len(failed)
+        self.errors += len(failed)
+        self.progress.sent([chunk for key, chunk in chunks], {chunk for key, chunk in chunks if key in failed})
+
+    def _pop(self, memc_addr):
+        del self.deadlines[memc_addr]
+        return memc_addr, self.batches.pop(memc_addr), self.batch_chunks.pop(memc_addr)
+
+
+def retry_delays():
+    """Yield seconds to sleep before every write attempt: none before the first one, then exponential backoff"""
+    yield 0
+    for n in range(config['MEMC_MAX_RETRIES'] - 1):
+        yield config['MEMC_BACKOFF_FACTOR'] * (2 ** n)
+
+
+def handle_task(send_queue, result_queue, progress, aborted, dry_run=False):
+    clients = {}
+    batcher = Batcher(progress, dry_run)
+
+    def write(memc_addr, batch, chunks):
+        memc = clients.get(memc_addr)
+        if memc is None:
+            memc = clients[memc_addr] = memcache.Client([memc_addr], socket_timeout=config['MEMC_TIMEOUT'])
+        batcher.written(batch, chunks, insert_appsinstalled(memc, memc_addr, batch))
 
-        memc_pool, memc_addr, appsinstalled, dry_run = task
-        ok = insert_appsinstalled(memc_pool, memc_addr, appsinstalled, dry_run)
-        if ok:
-            processed += 1
-        else:
-            errors += 1
+    while True:
+        item = get_records(send_queue, batcher.timeout())
+        if aborted.is_set():
+            return
+        if item is None:
+            for ready in batcher.drain():
+                write(*ready)
+            result_queue.put((batcher.processed, batcher.errors, 0))
+            return
+        for ready in batcher.add(*item):
+            write(*ready)
 
 
-def handle_logfile(fn, options):
-    device_memc = {
-        'idfa': options.idfa,
-        'gaid': options.gaid,
-        'adid': options.adid,
-        'dvid': options.dvid,
-    }
+def get_records(send_queue, timeout):
+    """Return next (chunk, records) item, (None, ()) on timeout or None on stop marker
 
-    pools = collections.defaultdict(Queue.Queue)
-    job_queue = Queue.Queue(maxsize=config['MAX_JOB_QUEUE_SIZE'])
-    result_queue = Queue.Queue(maxsize=config['MAX_RESULT_QUEUE_SIZE'])
+    Waits at most SEND_POLL_INTERVAL, so a sender checks for an aborted load and is never stuck in get.
+    """
+    timeout = config['SEND_POLL_INTERVAL'] if timeout is None else min(timeout, config['SEND_POLL_INTERVAL'])
+    try:
+        return send_queue.get(timeout=timeout)
+    except queue.Empty:
+        return None, ()
+
+
+async def send_records(send_queue, progress, aborted, dry_run=False):
+    """Batch records per shard and write them through pipelined connections, return (processed, errors)"""
+    loop = asyncio.get_running_loop()
+    writer = memc_async.MemcacheWriter(config['MEMC_CONNECTIONS'], config['MEMC_WINDOW'], config['MEMC_TIMEOUT'])
+    batcher = Batcher(progress, dry_run)
+    writes = set()
+    crashed = []
+
+    async def write(memc_addr, batch, chunks):
+        failed = list(batch)
+        for delay in retry_delays():
+            await asyncio.sleep(delay)
+            failed = await writer.set_multi(memc_addr, {key: batch[key] for key in failed})
+            if not failed:
+                break
+        batcher.written(batch, chunks, failed)
+
+    def write_done(task):
+        writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            crashed.append(task.exception())
+
+    async def flush(ready):
+        while len(writes) >= config['MEMC_WINDOW']:
+            await asyncio.wait(writes, return_when=asyncio.FIRST_COMPLETED)
+        if crashed:
+            raise crashed[0]
+        task = loop.create_task(write(*ready))
+        writes.add(task)
+        task.add_done_callback(write_done)
 
-    workers = []
-    for i in range(config['THREADS_PER_WORKER']):
-        thread = threading.Thread(target=handle_task, args=(job_queue, result_queue))
-        thread.daemon = True
-        workers.append(thread)
+    try:
+        while True:
+            item = await loop.run_in_executor(None, partial(get_records, send_queue, batcher.timeout()))
+            if aborted.is_set():
+                return batcher.processed, batcher.errors
+            if item is None:
+                break
+            for ready in batcher.add(*item):
+                await flush(ready)
 
-    for thread in workers:
-        thread.start()
+        for ready in batcher.drain():
+            await flush(ready)
+        if writes:
+            await asyncio.wait(writes)
+        if crashed:
+            raise crashed[0]
+    finally:
+        await writer.close()
+    return batcher.processed, batcher.errors
 
-    processed = errors = 0
-    logging.info(f'Processing {fn}')
 
-    with gzip.open(fn) as fd:
-        for line in fd:
-            line = line.strip()
-            if not line:
-                continue
+def handle_task_async(send_queue, result_queue, progress, aborted, dry_run=False):
+    processed, errors = asyncio.run(send_records(send_queue, progress, aborted, dry_run))
+    result_queue.put((processed, errors, 0))
 
-            appsinstalled = parse_appsinstalled(line)
-            if not appsinstalled:
-                errors += 1
-                continue
 
-            memc_addr = device_memc.get(appsinstalled.dev_type)
-            if not memc_addr:
-                errors += 1
-                logging.error(f'Unknow device type: {appsinstalled.dev_type}')
-                continue
+def run_stage(target, stage, cpu_queue, thread, *args):
+    """Run stage worker and report the CPU time it used"""
+    target(*args)
+    cpu_queue.put((stage, time.thread_time() if thread else time.process_time()))
 
-            job_queue.put((pools[memc_addr], memc_addr, appsinstalled, options.dry))
 
-            if not all(thread.is_alive() for thread in workers):
+def run_thread(target, *args):
+    """Run stage thread and set exitcode on it like a process has, so join_stage notices a thread that raised"""
+    thread = threading.current_thread()
+    try:
+        target(*args)
+    except BaseException:
+        thread.exitcode = 1
+        raise
+    thread.exitcode = 0
+
+
+def start_stage(target, count, *args, thread=False, cpu_queue=None, stage=None):
+    workers = []
+    if cpu_queue is not None:
+        target, args = run_stage, (target, stage, cpu_queue, thread) + args
+    for i in range(count):
+        if thread:
+            worker = threading.Thread(target=run_thread, args=(target,) + args, daemon=True)
+            worker.exitcode = None
+        else:
+            worker = multiprocessing.Process(target=target, args=args, daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def join_stage(workers, pipeline, output_queue=None, consumers=0):
+    """Wait for stage workers and pass one stop marker to every consumer of the next stage
+
+    Raises RuntimeError as soon as any process or thread of the pipeline failed, its consumers or producers
+    would wait on the queues forever otherwise.
+    """
+    for worker in workers:
+        while True:
+            worker.join(timeout=1)
+            failed = [w for w in pipeline if w.exitcode]
+            if failed:
+                raise RuntimeError(f'Pipeline worker {failed[0].name} exited with code {failed[0].exitcode}')
+            if not worker.is_alive():
                 break
+    for _ in range(consumers):
+        output_queue.put(None)
 
-    for thread in workers:
-        if thread.is_alive():
-            thread.join()
 
-    while not result_queue.empty():
-        processed_per_worker, errors_per_worker = result_queue.get()
+def handle_logfile(fn, options):
+    """Load file through decompress -> parse -> serialize -> send stages joined by bounded queues"""
+    device_memc = {
+        'idfa': options.idfa,
+        'gaid': options.gaid,
+        'adid': options.adid,
+        'dvid': options.dvid,
+    }
+    serialize_inline = not options.serializers
+    parse_queue = multiprocessing.Queue(maxsize=config['MAX_STAGE_QUEUE_SIZE'])
+    serialize_queue = multiprocessing.Queue(maxsize=config['MAX_STAGE_QUEUE_SIZE'])
+    send_queue = multiprocessing.Queue(maxsize=config['MAX_STAGE_QUEUE_SIZE'])
+    result_queue = multiprocessing.Queue()
+    cpu_queue = multiprocessing.Queue()
+    progress = checkpoint.Progress(None if options.dry else fn, options.checkpoint_interval)
+    aborted = threading.Event()
+    logging.info(f'Processing {fn}')
+    if progress.lines:
+        logging.info(f'Resuming {fn}: {progress.lines} lines were loaded by previous run')
+
+    if options.asyncio:
+        senders = start_stage(handle_task_async, 1, send_queue, result_queue, progress, aborted, options.dry,
+                              thread=True, cpu_queue=cpu_queue, stage='send')
+    else:
+        senders = start_stage(handle_task, options.senders, send_queue, result_queue, progress, aborted, options.dry,
+                              thread=True, cpu_queue=cpu_queue, stage='send')
+    serializers = start_stage(handle_serialize, options.serializers, serialize_queue, send_queue, options.dry,
+                              cpu_queue=cpu_queue, stage='serialize')
+    parsers = start_stage(handle_parse, options.parsers, parse_queue,
+                          send_queue if serialize_inline else serialize_queue,
+                          result_queue, device_memc, serialize_inline, options.dry,
+                          cpu_queue=cpu_queue, stage='parse')
+    decompressor = start_decompress(fn, options.decompressors, parse_queue, progress.done, cpu_queue)
+    pipeline = decompressor + parsers + serializers
+    try:
+        join_stage(decompressor, pipeline + senders, parse_queue, len(parsers))
+        if serialize_inline:
+            join_stage(parsers, pipeline + senders, send_queue, len(senders))
+        else:
+            join_stage(parsers, pipeline + senders, serialize_queue, len(serializers))
+            join_stage(serializers, pipeline + senders, send_queue, len(senders))
+        join_stage(senders, pipeline + senders)
+    finally:
+        aborted.set()
+        for worker in pipeline:
+            if worker.is_alive():
+                worker.terminate()
+        progress.save()
+
+    processed = errors = slow = 0
+    for _ in range(len(parsers) + len(senders)):
+        processed_per_worker, errors_per_worker, slow_per_worker = result_queue.get()
         processed += processed_per_worker
         errors += errors_per_worker
+        slow += slow_per_worker
+    if slow:
+        logging.info(f'{slow} malformed lines went through slow parser')
+
+    stage_cpu = collections.Counter({'decompress': 0, 'parse': 0, 'serialize': 0, 'send': 0})
+    for _ in range(len(pipeline) + len(senders)):
+        stage, cpu = cpu_queue.get()
+        stage_cpu[stage] += cpu
+    logging.info('Stage CPU seconds: ' + ' '.join(f'{stage}={cpu:.3f}' for stage, cpu in stage_cpu.items()))
 
     if processed:
         err_rate = float(errors) / processed
@@ -165,12 +568,20 @@ def handle_logfile(fn, options):
 
 
 def main(options):
-    num_processes = multiprocessing.cpu_count()
-    pool = multiprocessing.Pool(processes=num_processes)
-    fnames = sorted(fn for fn in glob.iglob(options.pattern))
-    handler = partial(handle_logfile, options=options)
-    for fn in pool.imap(handler, fnames):
+    for fn in sorted(glob.iglob(options.pattern)):
+        handle_logfile(fn, options)
         dot_rename(fn)
+        gzindex.remove_index(fn)
+        checkpoint.remove(fn)
+
+
+def build_indexes(options):
+    if not gzindex.available():
+        logging.error('Cannot build gzip indexes: zlib shared library not found')
+        return
+    for fn in sorted(glob.iglob(options.pattern)):
+        logging.info(f'Building gzip index for {fn}')
+        gzindex.save_index(fn, gzindex.build_index(fn, config['GZIP_INDEX_SPAN']))
 
 
 def prototest():
@@ -189,22 +600,82 @@ def prototest():
         assert ua == unpacked
 
 
+def parser_benchmark(count=200000, apps_per_line=50):
+    lines = [
+        '{}\t{}\t{:.6f}\t{:.6f}\t{}'.format(
+            random.choice(('idfa', 'gaid', 'adid', 'dvid')), os.urandom(16).hex(),
+            random.uniform(-90, 90), random.uniform(-180, 180),
+            ','.join(str(random.randint(1, 100000)) for _ in range(random.randint(1, apps_per_line * 2)))
+        ).encode()
+        for _ in range(count)
+    ]
+
+    def original_parser(line):
+        # Parser and serializer before the bytes fast path: decode, split and a list of ints
+        dev_type, dev_id, lat, lon, raw_apps = line.decode().strip().split('\t')
+        return dev_type, dev_id, float(lat), float(lon), [int(a.strip()) for a in raw_apps.split(',')]
+
+    def original_serializer(appsinstalled):
+        dev_type, dev_id, lat, lon, apps = appsinstalled
+        ua = appsinstalled_pb2.UserApps()
+        ua.lat = lat
+        ua.lon = lon
+        ua.apps.extend(apps)
+        return f'{dev_type}:{dev_id}', ua
+
+    parsers = [
+        ('original', original_parser, original_serializer),
+        ('slow', parse_appsinstalled_slow, serialize_appsinstalled),
+        ('fast (array)', partial(parse_appsinstalled, parse_apps=parse_apps_array), serialize_appsinstalled),
+    ]
+    if numpy is not None:
+        parsers.append(
+            ('fast (numpy)', partial(parse_appsinstalled, parse_apps=parse_apps_numpy), serialize_appsinstalled)
+        )
+    baseline = {}
+    for name, parser, serializer in parsers:
+        started = time.perf_counter()
+        parsed = [parser(line) for line in lines]
+        parse_rate = count / (time.perf_counter() - started)
+        started = time.perf_counter()
+        for appsinstalled in parsed:
+            serializer(appsinstalled)[1].SerializeToString()
+        total_rate = count / (time.perf_counter() - started + count / parse_rate)
+        baseline = baseline or {'parse': parse_rate, 'total': total_rate}
+        logging.info(f'{name} parser: {parse_rate:.0f} lines/s ({parse_rate / baseline["parse"]:.2f}x), '
+                     f'with serialization {total_rate:.0f} lines/s ({total_rate / baseline["total"]:.2f}x)')
+
+
 if __name__ == '__main__':
     op = OptionParser()
     op.add_option('-t', '--test', action='store_true', default=False)
     op.add_option('-l', '--log', action='store', default=None)
+    op.add_option('--bench-parser', action='store_true', default=False)
+    op.add_option('--build-index', action='store_true', default=False)
     op.add_option('--dry', action='store_true', default=False)
     op.add_option('--pattern', action='store', default='/data/appsinstalled/*.tsv.gz')
     op.add_option('--idfa', action='store', default='127.0.0.1:33013')
     op.add_option('--gaid', action='store', default='127.0.0.1:33014')
     op.add_option('--adid', action='store', default='127.0.0.1:33015')
     op.add_option('--dvid', action='store', default='127.0.0.1:33016')
+    op.add_option('--decompressors', action='store', type='int', default=config['DECOMPRESS_PROCESSES'])
+    op.add_option('--parsers', action='store', type='int', default=config['PARSE_PROCESSES'])
+    op.add_option('--serializers', action='store', type='int', default=config['SERIALIZE_PROCESSES'])
+    op.add_option('--senders', action='store', type='int', default=config['SEND_THREADS'])
+    op.add_option('--asyncio', action='store_true', default=False)
+    op.add_option('--checkpoint-interval', action='store', type='float', default=config['CHECKPOINT_INTERVAL'])
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
     if opts.test:
         prototest()
         sys.exit(0)
+    if opts.bench_parser:
+        parser_benchmark()
+        sys.exit(0)
+    if opts.build_index:
+        build_indexes(opts)
+        sys.exit(0)
 
     logging.info(f'Memc loader started with options: {opts}')
     try:
@@ -0,0 +1,131 @@
+import gzip
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import TestCase, mock
+
+import checkpoint
+import memc_load
+from bench import FakeCluster, generate_file
+
+MEMC_LOAD = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'memc_load.py')
+KILL_TIMEOUT = 30
+LINES = 100000
+REPLY_TIMEOUT = 0.2
+
+
+class ProgressTest(TestCase):
+
+    def test_ack_merges_ranges(self):
+        progress = checkpoint.Progress(None, 0)
+        for chunk in ((0, 10, 1), (20, 30, 1), (10, 20, 1)):
+            progress.start(chunk, 1)
+            progress.sent([chunk])
+        self.assertEqual(progress.done, [(0, 30)])
+        self.assertEqual(progress.lines, 3)
+
+    def test_failed_chunk_is_not_acknowledged(self):
+        progress = checkpoint.Progress(None, 0)
+        progress.start((0, 10, 2), 2)
+        progress.start((10, 20, 1), 1)
+        progress.sent([(0, 10, 2), (10, 20, 1)], {(0, 10, 2)})
+        progress.sent([(0, 10, 2)])
+        self.assertEqual(progress.done, [(10, 20)])
+        self.assertEqual(progress.lines, 1)
+        self.assertEqual(progress.pending, {})
+
+
+class ResumeTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='memc-load-test-')
+        self.path = os.path.join(self.dir, 'appsinstalled.tsv.gz')
+        generate_file(self.path, LINES, 1024 * 1024 * 1024, 2, 'uniform', 0, 0)
+        self.cluster = FakeCluster(latency=0.005, error_rate=0.0002, store=True)
+        self.cluster.start()
+
+    def tearDown(self):
+        self.cluster.stop()
+        shutil.rmtree(self.dir)
+
+    def memc_load(self):
+        command = [sys.executable, MEMC_LOAD, '--pattern', self.path, '--senders', '1', '--checkpoint-interval', '0']
+        for dev_type, address in self.cluster.addresses.items():
+            command += ['--' + dev_type, address]
+        return command
+
+    def test_resume_after_kill_sends_failed_keys_again(self):
+        loader = subprocess.Popen(self.memc_load(), start_new_session=True, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + KILL_TIMEOUT
+        while time.monotonic() < deadline and loader.poll() is None and self.loaded_lines() < LINES // 2:
+            time.sleep(0.05)
+        os.killpg(loader.pid, signal.SIGKILL)
+        loader.wait()
+        self.assertTrue(os.path.exists(self.path), 'loader finished before it was killed')
+        self.assertGreater(self.cluster.errors, 0)
+        resumed_from = self.loaded_lines()
+        self.assertGreater(resumed_from, 0)
+
+        for server in self.cluster.servers.values():
+            server.error_rate = 0
+            server.sets = 0
+        subprocess.run(self.memc_load(), check=True, stderr=subprocess.DEVNULL)
+
+        with gzip.open(self.path.replace('appsinstalled', '.appsinstalled')) as fd:
+            expected = {b':'.join(line.split(b'\t')[:2]) for line in fd}
+        stored = set()
+        for server in self.cluster.servers.values():
+            stored.update(server.data)
+        self.assertEqual(expected - stored, set())
+        self.assertLess(self.cluster.sets, len(expected))
+
+    def loaded_lines(self):
+        try:
+            with open(checkpoint.state_path(self.path)) as fd:
+                return json.load(fd)['lines']
+        except (OSError, ValueError):
+            return 0
+
+
+class ReplyTimeoutTest(TestCase):
+    LINES = 2000
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='memc-load-test-')
+        self.path = os.path.join(self.dir, 'appsinstalled.tsv.gz')
+        generate_file(self.path, self.LINES, 1024 * 1024 * 1024, 2, 'uniform', 0, 0)
+        self.cluster = FakeCluster(latency=REPLY_TIMEOUT * 3, store=True)
+        self.cluster.start()
+
+    def tearDown(self):
+        self.cluster.stop()
+        shutil.rmtree(self.dir)
+
+    def options(self, asyncio):
+        return SimpleNamespace(dry=False, checkpoint_interval=0, asyncio=asyncio, senders=1, parsers=1,
+                               serializers=0, decompressors=1, **self.cluster.addresses)
+
+    def test_timed_out_keys_are_sent_again(self):
+        for asyncio in (False, True):
+            # Small chunks fit in the first batch of every shard, which is the one that times out
+            config = dict(MEMC_TIMEOUT=REPLY_TIMEOUT, CHUNK_SIZE=4096)
+            with self.subTest(asyncio=asyncio), mock.patch.dict(memc_load.config, config):
+                for server in self.cluster.servers.values():
+                    server.latency = REPLY_TIMEOUT * 3
+                memc_load.handle_logfile(self.path, self.options(asyncio))
+                with open(checkpoint.state_path(self.path)) as fd:
+                    self.assertEqual(json.load(fd)['lines'], 0)
+
+                self.cluster.reset()
+                for server in self.cluster.servers.values():
+                    server.latency = 0
+                memc_load.handle_logfile(self.path, self.options(asyncio))
+                self.assertEqual(self.cluster.sets, self.LINES)
+                checkpoint.remove(self.path)
+                self.cluster.reset()
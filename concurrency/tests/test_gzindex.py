@@ -0,0 +1,80 @@
+import gzip
+import os
+import queue
+import random
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+import gzindex
+from memc_load import handle_decompress_range
+
+LINES = 30000
+
+
+@skipIf(not gzindex.available(), 'zlib shared library not found')
+class SplitRangesTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rnd = random.Random(0)
+        cls.data = ''.join(
+            '{}\t{:032x}\t{}\n'.format(rnd.choice(('idfa', 'gaid')), rnd.getrandbits(128),
+                                       ','.join(str(rnd.randint(1, 100000)) for _ in range(rnd.randint(1, 20))))
+            for _ in range(LINES)
+        ).encode()
+        cls.dir = tempfile.mkdtemp(prefix='gzindex-test-')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def write(self, members):
+        """Write data as gzip members that are cut in the middle of lines, return path"""
+        path = os.path.join(self.dir, f'{members}.tsv.gz')
+        cuts = [0] + [len(self.data) * n // members + 7 for n in range(1, members)] + [len(self.data)]
+        with open(path, 'wb') as fd:
+            for start, end in zip(cuts, cuts[1:]):
+                fd.write(gzip.compress(self.data[start:end]))
+        return path
+
+    def decompress_ranges(self, path, span, count):
+        ranges = gzindex.split_index(gzindex.build_index(path, span), count)
+        chunks = []
+        for point, end in ranges:
+            parse_queue = queue.Queue()
+            handle_decompress_range(path, point, end, parse_queue)
+            while not parse_queue.empty():
+                chunks.append(parse_queue.get())
+        return ranges, chunks
+
+    def test_ranges_reproduce_file(self):
+        for members in (1, 3):
+            path = self.write(members)
+            with open(path, 'rb') as fd:
+                self.assertEqual(gzip.decompress(fd.read()), self.data)
+            for span, count in ((64 * 1024, 1), (64 * 1024, 3), (128 * 1024, 4), (256 * 1024, 7)):
+                with self.subTest(members=members, span=span, count=count):
+                    ranges, chunks = self.decompress_ranges(path, span, count)
+                    self.assertLessEqual(len(ranges), count)
+                    self.assertEqual(b''.join(data for chunk, data in chunks), self.data)
+                    self.assertEqual(chunks[0][0][0], 0)
+                    self.assertEqual(chunks[-1][0][1], len(self.data))
+                    for (prev, _), (chunk, data) in zip(chunks, chunks[1:]):
+                        self.assertEqual(chunk[0], prev[1])
+                        self.assertEqual(chunk[1] - chunk[0], len(data))
+                    self.assertEqual(sum(chunk[2] for chunk, data in chunks), LINES)
+
+    def test_split_uses_several_ranges(self):
+        ranges = gzindex.split_index(gzindex.build_index(self.write(3), 64 * 1024), 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual([end for point, end in ranges[:-1]], [point.out for point, end in ranges[1:]])
+
+    def test_index_cache_is_invalidated(self):
+        path = self.write(1)
+        index = gzindex.get_index(path, 64 * 1024)
+        self.assertEqual(gzindex.load_index(path), index)
+        with open(path, 'ab') as fd:
+            fd.write(gzip.compress(b'tail\n'))
+        self.assertIsNone(gzindex.load_index(path))
+        gzindex.remove_index(path)
@@ -0,0 +1,102 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+import memcache
+
+from bench import FakeCluster
+from memc_async import MemcacheConnection, MemcacheWriter
+from memc_load import insert_appsinstalled
+
+REPLY_TIMEOUT = 0.2
+
+
+class InsertAppsinstalledTest(TestCase):
+
+    def setUp(self):
+        self.cluster = FakeCluster(store=True)
+        self.cluster.start()
+        self.server = self.cluster.servers['idfa']
+        self.address = self.cluster.addresses['idfa']
+        self.memc = memcache.Client([self.address], socket_timeout=REPLY_TIMEOUT)
+
+    def tearDown(self):
+        self.memc.disconnect_all()
+        self.cluster.stop()
+
+    def test_stored(self):
+        batch = {f'idfa:{n}': b'value' for n in range(50)}
+        self.assertEqual(insert_appsinstalled(self.memc, self.address, batch), [])
+        self.assertEqual(len(self.server.data), 50)
+
+    def test_server_error_fails_key(self):
+        self.server.error_rate = 1
+        batch = {f'idfa:{n}': b'value' for n in range(5)}
+        self.assertCountEqual(insert_appsinstalled(self.memc, self.address, batch), batch)
+
+    def test_reply_timeout_fails_every_key(self):
+        self.server.latency = REPLY_TIMEOUT * 3
+        batch = {f'idfa:{n}': b'value' for n in range(50)}
+        self.assertCountEqual(insert_appsinstalled(self.memc, self.address, batch), batch)
+
+
+class ScriptedMemcached:
+    """Server that reads the given number of set commands, then writes replies in pieces of fragment bytes"""
+
+    def __init__(self, commands, replies, fragment=3):
+        self.commands = commands
+        self.replies = replies
+        self.fragment = fragment
+        self.received = b''
+
+    async def handle(self, reader, writer):
+        while self.received.count(b'\r\n') < 2 * self.commands:
+            data = await reader.read(65536)
+            if not data:
+                return
+            self.received += data
+        for pos in range(0, len(self.replies), self.fragment):
+            writer.write(self.replies[pos:pos + self.fragment])
+            await writer.drain()
+        await reader.read()
+        writer.close()
+
+
+class MemcacheConnectionTest(IsolatedAsyncioTestCase):
+
+    async def serve(self, server):
+        listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        self.addAsyncCleanup(listener.wait_closed)
+        self.addCleanup(listener.close)
+        return '127.0.0.1:{}'.format(listener.sockets[0].getsockname()[1])
+
+    async def test_replies_matched_across_pipelined_batches(self):
+        server = ScriptedMemcached(5, b'STORED\r\nNOT_STORED\r\nSTORED\r\nSTORED\r\nSERVER_ERROR out of memory\r\n')
+        conn = await MemcacheConnection.open(await self.serve(server), 1)
+        first, second = await asyncio.gather(
+            conn.set_multi({'a': b'1', 'b': b'2', 'c': b'3'}),
+            conn.set_multi({'d': b'4', 'e': b'5'}),
+        )
+        conn.close()
+        self.assertEqual((first, second), (['b'], ['e']))
+        self.assertEqual(server.received.count(b'set '), 5)
+
+    async def test_invalid_keys_are_not_sent(self):
+        server = ScriptedMemcached(1, b'STORED\r\n')
+        conn = await MemcacheConnection.open(await self.serve(server), 1)
+        invalid = ['with space', 'ctl\x01', 'k' * 251]
+        failed = await conn.set_multi(dict.fromkeys(['ok'] + invalid, b'1'))
+        self.assertEqual(await conn.set_multi(dict.fromkeys(invalid, b'1')), invalid)
+        conn.close()
+        self.assertEqual(failed, invalid)
+        self.assertEqual(server.received, b'set ok 0 0 1\r\n1\r\n')
+
+    async def test_timeout_fails_every_in_flight_key(self):
+        server = ScriptedMemcached(10, b'')
+        writer = MemcacheWriter(connections=1, window=4, timeout=0.2)
+        address = await self.serve(server)
+        first, second = await asyncio.gather(
+            writer.set_multi(address, {'a': b'1', 'b': b'2'}),
+            writer.set_multi(address, {'c': b'3'}),
+        )
+        await writer.close()
+        self.assertEqual((first, second), (['a', 'b'], ['c']))
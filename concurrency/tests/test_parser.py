@@ -0,0 +1,61 @@
+from unittest import TestCase, skipIf
+
+from memc_load import MAX_APP_ID, numpy, parse_apps_array, parse_apps_numpy, parse_appsinstalled, \
+    parse_appsinstalled_slow
+
+PARSE_APPS_BACKENDS = [parse_apps_array] + ([parse_apps_numpy] if numpy is not None else [])
+
+
+class ParseAppsTest(TestCase):
+
+    def assertAllBackends(self, raw_apps, expected):
+        for parse_apps in PARSE_APPS_BACKENDS:
+            with self.subTest(backend=parse_apps.__name__, raw_apps=raw_apps):
+                if expected is None:
+                    with self.assertRaises(ValueError):
+                        parse_apps(raw_apps)
+                else:
+                    self.assertEqual(list(parse_apps(raw_apps)), expected)
+
+    def test_valid_apps(self):
+        self.assertAllBackends(b'1423,43,567', [1423, 43, 567])
+        self.assertAllBackends(b'7', [7])
+        self.assertAllBackends(b'0,1', [0, 1])
+        self.assertAllBackends(b'7423,424\r', [7423, 424])
+        self.assertAllBackends(str(MAX_APP_ID).encode(), [MAX_APP_ID])
+
+    def test_app_id_overflow(self):
+        self.assertAllBackends(b'5000000000', None)
+        self.assertAllBackends(b'4294967296,1', None)
+        self.assertAllBackends(b'1,99999999999999999999', None)
+
+    def test_not_plain_decimal(self):
+        for raw_apps in (b'+5', b'1_000', b'-1', b'1,-1,3', b' 5', b'1.5', b'1,a,3', b'1,,2', b'1,', b'', b'0x10'):
+            self.assertAllBackends(raw_apps, None)
+
+    @skipIf(numpy is None, 'numpy is not installed')
+    def test_backends_return_uint32(self):
+        self.assertEqual(parse_apps_array(b'1,2').itemsize, 4)
+        self.assertEqual(parse_apps_numpy(b'1,2').dtype, numpy.uint32)
+
+
+class ParseAppsInstalledTest(TestCase):
+
+    def test_fast_path(self):
+        dev_type, dev_id, lat, lon, apps = parse_appsinstalled(b'idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43,567')
+        self.assertEqual((dev_type, dev_id, lat, lon, list(apps)), ('idfa', '1rfw452y52g2gq4g', 55.55, 42.42,
+                                                                     [1423, 43, 567]))
+
+    def test_fast_path_rejects_malformed(self):
+        for line in (b'', b'idfa\tid\t1\t2', b'\tid\t1\t2\t1', b'idfa\tid\tx\t2\t1', b'idfa\tid\t1\t2\t5000000000'):
+            with self.subTest(line=line), self.assertRaises(ValueError):
+                parse_appsinstalled(line)
+
+    def test_slow_path_keeps_valid_apps(self):
+        dev_type, dev_id, lat, lon, apps = parse_appsinstalled_slow(b'gaid\tid\t1.5\tq\t1,+2,a,4294967296,3')
+        self.assertEqual((dev_type, dev_id, lat, lon, list(apps)), ('gaid', 'id', None, None, [1, 3]))
+
+    def test_slow_path_rejects_unusable(self):
+        for line in (b'', b'idfa\tid\t1\t2', b'\tid\t1\t2\t1'):
+            with self.subTest(line=line):
+                self.assertIsNone(parse_appsinstalled_slow(line))
@@ -0,0 +1,71 @@
+import queue
+import threading
+from unittest import TestCase
+
+import checkpoint
+from memc_load import Batcher, config, handle_task, handle_task_async, join_stage, start_stage
+
+
+def fail():
+    raise OSError('No space left on device')
+
+
+def wait(event):
+    event.wait()
+
+
+class JoinStageTest(TestCase):
+
+    def test_failed_thread_stops_join(self):
+        event = threading.Event()
+        waiting = start_stage(wait, 1, event, thread=True)
+        failing = start_stage(fail, 1, thread=True)
+        try:
+            with self.assertRaisesRegex(RuntimeError, 'exited with code 1'):
+                join_stage(waiting, waiting + failing)
+        finally:
+            event.set()
+
+    def test_stop_markers_after_join(self):
+        event = threading.Event()
+        event.set()
+        output_queue = queue.Queue()
+        workers = start_stage(wait, 2, event, thread=True)
+        join_stage(workers, workers, output_queue, 3)
+        self.assertEqual([output_queue.get_nowait() for _ in range(3)], [None] * 3)
+        self.assertEqual([worker.exitcode for worker in workers], [0, 0])
+
+
+class BatcherTest(TestCase):
+
+    def test_full_batch_is_ready(self):
+        batcher = Batcher(checkpoint.Progress(None, 0))
+        records = [('a:1', f'key{n}', b'') for n in range(config['MEMC_BATCH_SIZE'] + 1)]
+        ready = batcher.add((0, 10, len(records)), records)
+        self.assertEqual([(memc_addr, len(batch)) for memc_addr, batch, chunks in ready],
+                         [('a:1', config['MEMC_BATCH_SIZE'])])
+        self.assertEqual([(memc_addr, len(batch)) for memc_addr, batch, chunks in batcher.drain()], [('a:1', 1)])
+        self.assertIsNone(batcher.timeout())
+
+    def test_written_counts_and_acknowledges(self):
+        progress = checkpoint.Progress(None, 0)
+        batcher = Batcher(progress)
+        batcher.add((0, 10, 2), [('a:1', 'k1', b''), ('b:1', 'k2', b'')])
+        batcher.add((10, 20, 1), [('a:1', 'k3', b'')])
+        for memc_addr, batch, chunks in batcher.drain():
+            batcher.written(batch, chunks, ['k2'] if 'k2' in batch else [])
+        self.assertEqual((batcher.processed, batcher.errors), (2, 1))
+        self.assertEqual(progress.done, [(10, 20)])
+
+
+class SenderTest(TestCase):
+
+    def test_senders_stop_on_abort(self):
+        for sender in (handle_task, handle_task_async):
+            with self.subTest(sender=sender.__name__):
+                aborted = threading.Event()
+                workers = start_stage(sender, 1, queue.Queue(), queue.Queue(), checkpoint.Progress(None, 0), aborted,
+                                      thread=True)
+                aborted.set()
+                workers[0].join(timeout=5)
+                self.assertFalse(workers[0].is_alive())
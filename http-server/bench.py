@@ -0,0 +1,298 @@
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter
+
+FILE_SIZES = {
+    'tiny': 128,
+    '64k': 64 * 1024,
+    '50m': 50 * 1024 * 1024,
+}
+PERCENTILES = (50, 90, 99, 99.9)
+HISTOGRAM_BASE = 1.01
+RECV_BUFFER_SIZE = 256 * 1024
+SERVER_START_TIMEOUT = 10
+
+
+class Histogram:
+    def __init__(self, buckets=None):
+        self.buckets = Counter(buckets or {})
+
+    def add(self, seconds):
+        self.buckets[int(math.log(max(seconds * 1e6, 1), HISTOGRAM_BASE))] += 1
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+
+    @property
+    def count(self):
+        return sum(self.buckets.values())
+
+    def percentile(self, percent):
+        threshold = self.count * percent / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= threshold:
+                return round(HISTOGRAM_BASE ** (bucket + 1) / 1000, 3)
+        return 0
+
+    def to_dict(self):
+        return {str(bucket): count for bucket, count in sorted(self.buckets.items())}
+
+
+class ClientStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.histogram = Histogram()
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.histogram.merge(other.histogram)
+
+
+def read_response(sock, buffer):
+    head = b''
+    while b'\r\n\r\n' not in head:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError('Connection closed before response headers')
+        head += data
+    head, body = head.split(b'\r\n\r\n', 1)
+    status = int(head.split(b' ', 2)[1])
+    content_length = 0
+    close = False
+    chunked = False
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            content_length = int(value)
+        elif name == b'connection':
+            close = value.strip().lower() == b'close'
+        elif name == b'transfer-encoding':
+            chunked = value.strip().lower() == b'chunked'
+    if chunked:
+        return status, read_chunked_body(sock, body), close
+
+    received = len(body)
+    while received < content_length:
+        size = sock.recv_into(buffer, min(len(buffer), content_length - received))
+        if not size:
+            raise ConnectionError('Connection closed before response body')
+        received += size
+    return status, received, close
+
+
+def read_chunked_body(sock, data):
+    received = 0
+    while True:
+        while b'\r\n' not in data:
+            data += recv_more(sock)
+        size_line, data = data.split(b'\r\n', 1)
+        size = int(size_line.split(b';', 1)[0], 16)
+        while len(data) < size + 2:
+            data += recv_more(sock)
+        data = data[size + 2:]
+        received += size
+        if not size:
+            return received
+
+
+def recv_more(sock):
+    data = sock.recv(RECV_BUFFER_SIZE)
+    if not data:
+        raise ConnectionError('Connection closed before response body')
+    return data
+
+
+def run_connection(address, path, keep_alive, deadline, stats):
+    buffer = memoryview(bytearray(RECV_BUFFER_SIZE))
+    connection_header = 'keep-alive' if keep_alive else 'close'
+    request = 'GET {} HTTP/1.1\r\nHost: {}\r\nConnection: {}\r\n\r\n'.format(
+        path, address[0], connection_header
+    ).encode()
+    sock = None
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            if sock is None:
+                sock = socket.create_connection(address)
+            sock.sendall(request)
+            status, size, close = read_response(sock, buffer)
+        except OSError:
+            stats.errors += 1
+            if sock is not None:
+                sock.close()
+            sock = None
+            continue
+        stats.histogram.add(time.monotonic() - started)
+        stats.requests += 1
+        stats.bytes += size
+        if status != 200:
+            stats.errors += 1
+        if not keep_alive or close:
+            sock.close()
+            sock = None
+    if sock is not None:
+        sock.close()
+
+
+def run_client_process(address, path, keep_alive, connections, duration, results):
+    deadline = time.monotonic() + duration
+    connection_stats = [ClientStats() for _ in range(connections)]
+    threads = [
+        threading.Thread(target=run_connection, args=(address, path, keep_alive, deadline, stats))
+        for stats in connection_stats
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    total = ClientStats()
+    for stats in connection_stats:
+        total.merge(stats)
+    results.put((total.requests, total.errors, total.bytes, dict(total.histogram.buckets)))
+
+
+def run_case(address, path, keep_alive, connections, processes, duration):
+    results = multiprocessing.Queue()
+    per_process = [connections // processes + (i < connections % processes) for i in range(processes)]
+    clients = [
+        multiprocessing.Process(
+            target=run_client_process,
+            args=(address, path, keep_alive, count, duration, results)
+        )
+        for count in per_process if count
+    ]
+    started = time.monotonic()
+    for client in clients:
+        client.start()
+
+    total = ClientStats()
+    for _ in clients:
+        requests, errors, size, buckets = results.get()
+        total.requests += requests
+        total.errors += errors
+        total.bytes += size
+        total.histogram.merge(Histogram(buckets))
+    for client in clients:
+        client.join()
+    elapsed = time.monotonic() - started
+
+    return {
+        'requests': total.requests,
+        'errors': total.errors,
+        'bytes': total.bytes,
+        'elapsed': round(elapsed, 3),
+        'requests_per_second': round(total.requests / elapsed, 1),
+        'bytes_per_second': round(total.bytes / elapsed, 1),
+        'latency_ms': {'p{}'.format(p): total.histogram.percentile(p) for p in PERCENTILES},
+        'histogram': {'base': HISTOGRAM_BASE, 'unit': 'us', 'buckets': total.histogram.to_dict()},
+    }
+
+
+def create_document_root(sizes):
+    root = tempfile.mkdtemp(prefix='httpd-bench-')
+    chunk = os.urandom(1024 * 1024)
+    modified = time.time() - 3600
+    for name in sizes:
+        size = FILE_SIZES[name]
+        path = os.path.join(root, name + '.bin')
+        with open(path, 'wb') as fd:
+            written = 0
+            while written < size:
+                written += fd.write(chunk[:size - written])
+        os.utime(path, (modified, modified))
+    return root
+
+
+def start_server(root, port, workers, mode, extra_args):
+    args = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'httpd.py'),
+        '-w', str(workers), '-m', mode, '-p', str(port), '-r', root,
+    ] + extra_args
+    server = subprocess.Popen(args, env=dict(os.environ, HOSTNAME='127.0.0.1'))
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('Server did not start on port {}'.format(port))
+
+
+def main(args):
+    sizes = args.sizes.split(',')
+    keep_alive_modes = {'on': [True], 'off': [False], 'both': [True, False]}[args.keep_alive]
+    root = create_document_root(sizes)
+    server = start_server(root, args.port, args.w, args.m, args.server_args.split())
+    report = {
+        'server': {'workers': args.w, 'mode': args.m, 'args': args.server_args},
+        'client': {'connections': args.c, 'processes': args.P, 'duration': args.d},
+        'results': [],
+    }
+    try:
+        for name in sizes:
+            for keep_alive in keep_alive_modes:
+                logging.info('Run {} keep-alive={}'.format(name, keep_alive))
+                result = run_case(
+                    ('127.0.0.1', args.port), '/{}.bin'.format(name), keep_alive, args.c, args.P, args.d
+                )
+                result.update({'file': name, 'size': FILE_SIZES[name], 'keep_alive': keep_alive})
+                report['results'].append(result)
+                logging.info('{requests_per_second} req/s, {bytes_per_second} B/s, latency {latency_ms}, '
+                             'errors {errors}'.format(**result))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(root)
+
+    output = json.dumps(report, indent=2)
+    if args.o:
+        with open(args.o, 'w') as fd:
+            fd.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Load generator and latency benchmark for httpd.py')
+    parser.add_argument('-w', help='Number of server workers', type=int, default=4)
+    parser.add_argument('-m', help='Server worker mode', default='sync')
+    parser.add_argument('-c', help='Number of concurrent connections', type=int, default=64)
+    parser.add_argument('-P', help='Number of client processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('-d', help='Duration of every case in seconds', type=float, default=10)
+    parser.add_argument('-o', help='Write JSON report to file instead of stdout')
+    parser.add_argument('--port', help='Server port', type=int, default=8080)
+    parser.add_argument('--sizes', help='Comma separated file sizes: tiny, 64k, 50m', default='tiny,64k,50m')
+    parser.add_argument('--keep-alive', help='Connection reuse', choices=['on', 'off', 'both'], default='both')
+    parser.add_argument('--server-args', help='Extra arguments for httpd.py', default='')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='[%(asctime)s] %(levelname).1s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        stream=sys.stderr,
+    )
+    main(args)
@@ -1,131 +1,1802 @@
+import asyncio
+import collections
+import email.utils
+import errno
+import functools
+import gzip
+import json
 import logging
+import multiprocessing
+import multiprocessing.connection
 import mimetypes
+import mmap
 import os
+import queue
+import random
+import select
+import selectors
+import signal
 import socket
+import sys
+import threading
+import time
+import uuid
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from multiprocessing import Process
 from urllib import parse, request
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
 NOT_ALLOWED = 405
+RANGE_NOT_SATISFIABLE = 416
+HEADER_TOO_LARGE = 431
+INTERNAL_SERVER_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+PARTIAL_CONTENT = 206
+NOT_MODIFIED = 304
+STATUS_LINES = {
+    OK: b'HTTP/1.1 200 OK\r\n',
+    PARTIAL_CONTENT: b'HTTP/1.1 206 Partial Content\r\n',
+    NOT_MODIFIED: b'HTTP/1.1 304 Not Modified\r\n',
+    BAD_REQUEST: b'HTTP/1.1 400 BAD REQUEST\r\n',
+    FORBIDDEN: b'HTTP/1.1 403 FORBIDDEN\r\n',
+    NOT_FOUND: b'HTTP/1.1 404 Not Found\r\n',
+    NOT_ALLOWED: b'HTTP/1.1 405 ERROR\r\n',
+    RANGE_NOT_SATISFIABLE: b'HTTP/1.1 416 Range Not Satisfiable\r\n',
+    HEADER_TOO_LARGE: b'HTTP/1.1 431 Request Header Fields Too Large\r\n',
+    INTERNAL_SERVER_ERROR: b'HTTP/1.1 500 Internal Server Error\r\n',
+    SERVICE_UNAVAILABLE: b'HTTP/1.1 503 Service Unavailable\r\n',
+}
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/x-javascript',
+    'image/svg+xml',
+)
+
+
+def is_compressible(mime_type):
+    return bool(mime_type) and (mime_type.startswith('text/') or mime_type in COMPRESSIBLE_TYPES)
+
+
+class CachedFile:
+    REFS_LOCK = threading.Lock()
+
+    def __init__(self, path, file, data, stat, source=None):
+        self.path = path
+        self.file = file
+        self.data = data
+        self.mapped = isinstance(data, mmap.mmap)
+        self.size = len(data) if data is not None else stat.st_size
+        self.mtime = stat.st_mtime_ns if stat is not None else source.mtime
+        self.inode = stat.st_ino if stat is not None else source.inode
+        if source is None:
+            self.mime_type = mimetypes.guess_type(request.pathname2url(path))[0]
+            self.etag = '"{:x}-{:x}"'.format(self.mtime, self.size)
+            self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+            encoding_headers = 'Vary: Accept-Encoding\r\n' if is_compressible(self.mime_type) else ''
+        else:
+            self.mime_type = source.mime_type
+            self.etag = source.etag[:-1] + '-gzip"'
+            self.last_modified = source.last_modified
+            encoding_headers = 'Content-Encoding: gzip\r\nVary: Accept-Encoding\r\n'
+        self.source_etag = source.etag if source is not None else None
+        self.header = 'Accept-Ranges: bytes\r\nETag: {}\r\nLast-Modified: {}\r\n{}'.format(
+            self.etag, self.last_modified, encoding_headers
+        ).encode()
+        self.type_header = 'Content-Type: {}\r\n'.format(self.mime_type).encode()
+        self.length_header = 'Content-Length: {}\r\n'.format(self.size).encode()
+        self.checked_at = time.monotonic()
+        self.refs = 0
+        self.evicted = False
+
+    def is_modified(self, stat):
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino) != (self.mtime, self.size, self.inode)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def slice(self, offset, count):
+        if self.data is not None:
+            return memoryview(self.data)[offset:offset + count]
+        return FileSegment(self, offset, count)
+
+    def acquire(self):
+        with self.REFS_LOCK:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.REFS_LOCK:
+            self.refs -= 1
+            if not self.evicted or self.refs:
+                return
+        self.close()
+
+    def evict(self):
+        with self.REFS_LOCK:
+            self.evicted = True
+            if self.refs:
+                return
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class FileCache:
+    MAX_ENTRIES = 512
+    MAX_SIZE = 64 * 1024 * 1024
+    SMALL_FILE_SIZE = 32 * 1024
+    MMAP_FILE_SIZE = 4 * 1024 * 1024
+    MAX_MAPPED_SIZE = 512 * 1024 * 1024
+    CHECK_INTERVAL = 1
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_size=MAX_SIZE, max_mapped_size=MAX_MAPPED_SIZE):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.max_mapped_size = max_mapped_size
+        self.size = 0
+        self.mapped_size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                if self._is_valid(entry):
+                    self.entries.move_to_end(path)
+                    return entry.acquire()
+                self._evict(path)
+
+        entry = self._load(path).acquire()
+        with self.lock:
+            self._evict(path)
+            self._store(path, entry)
+        return entry
+
+    def _is_valid(self, entry):
+        now = time.monotonic()
+        if now - entry.checked_at < self.CHECK_INTERVAL:
+            return True
+        try:
+            stat = os.stat(entry.path)
+        except OSError:
+            return False
+        if entry.is_modified(stat):
+            return False
+        entry.checked_at = now
+        return True
+
+    def _load(self, path, source=None):
+        file = open(path, 'rb')
+        stat = os.fstat(file.fileno())
+        if stat.st_size > self.MMAP_FILE_SIZE:
+            return CachedFile(path, file, None, stat, source)
+        with file:
+            if stat.st_size > self.SMALL_FILE_SIZE:
+                return CachedFile(path, None, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), stat, source)
+            return CachedFile(path, None, file.read(), stat, source)
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        if entry.mapped:
+            self.mapped_size += entry.size
+        elif entry.data is not None:
+            self.size += entry.size
+        while len(self.entries) > self.max_entries or self.size > self.max_size \
+                or self.mapped_size > self.max_mapped_size:
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        if entry.mapped:
+            self.mapped_size -= entry.size
+        elif entry.data is not None:
+            self.size -= entry.size
+        entry.evict()
+
+
+class GzipCache(FileCache):
+    MAX_ENTRIES = 256
+    MAX_SIZE = 32 * 1024 * 1024
+    MAX_COMPRESS_SIZE = 4 * 1024 * 1024
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_size=MAX_SIZE):
+        super().__init__(max_entries, max_size)
+
+    def get(self, file):
+        if not is_compressible(file.mime_type):
+            return None
+        with self.lock:
+            variant = self.entries.get(file.path)
+            if variant is not None:
+                if variant.source_etag == file.etag and (variant.path == file.path or self._is_valid(variant)):
+                    self.entries.move_to_end(file.path)
+                    return variant.acquire()
+                self._evict(file.path)
+
+        variant = self._load_sidecar(file) or self._compress(file)
+        if variant is None:
+            return None
+        variant.acquire()
+        with self.lock:
+            self._evict(file.path)
+            self._store(file.path, variant)
+        return variant
+
+    def _load_sidecar(self, file):
+        try:
+            variant = self._load(file.path + '.gz', file)
+        except OSError:
+            return None
+        if variant.mtime < file.mtime:
+            variant.close()
+            return None
+        return variant
+
+    def _compress(self, file):
+        if file.size > self.MAX_COMPRESS_SIZE:
+            return None
+        data = file.data if file.data is not None else os.pread(file.fileno(), file.size, 0)
+        return CachedFile(file.path, None, gzip.compress(data, self.COMPRESS_LEVEL, mtime=0), None, file)
+
+
+class FileSegment:
+    CHUNK_SIZE = 65536
+    SENDFILE_ERRORS = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP)
+
+    def __init__(self, file, offset, count):
+        self.file = file.acquire()
+        self.offset = offset
+        self.count = count
+        self.use_sendfile = hasattr(os, 'sendfile')
+
+    def send(self, sock):
+        while self.count:
+            try:
+                sent = self._send_chunk(sock)
+            except (BlockingIOError, InterruptedError):
+                return False
+            if not sent:
+                raise ConnectionError('File truncated or connection closed')
+            self.offset += sent
+            self.count -= sent
+        return True
+
+    def _send_chunk(self, sock):
+        if self.use_sendfile:
+            try:
+                return os.sendfile(sock.fileno(), self.file.fileno(), self.offset, self.count)
+            except OSError as e:
+                if e.errno not in self.SENDFILE_ERRORS:
+                    raise
+                self.use_sendfile = False
+        data = os.pread(self.file.fileno(), min(self.count, self.CHUNK_SIZE), self.offset)
+        return sock.send(data) if data else 0
+
+    def sendall(self, sock):
+        timeout = sock.gettimeout()
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_WRITE)
+            while not self.send(sock):
+                if not selector.select(timeout):
+                    raise socket.timeout('timed out')
+
+    def close(self):
+        if self.file is not None:
+            self.file.release()
+            self.file = None
+
+
+class ChunkedBody:
+    def __init__(self, chunks, chunked=True):
+        self.chunks = iter(chunks)
+        self.chunked = chunked
+        self.size = 0
+        self.done = False
+
+    def __iter__(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def next_frame(self):
+        if self.done:
+            return None
+        for data in self.chunks:
+            if data:
+                self.size += len(data)
+                return b'%x\r\n%b\r\n' % (len(data), data) if self.chunked else data
+        self.done = True
+        self.close()
+        return b'0\r\n\r\n' if self.chunked else None
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def read_chunks(path, chunk_size):
+    with open(path, 'rb') as fd:
+        data = fd.read(chunk_size)
+        while data:
+            yield data
+            data = fd.read(chunk_size)
+
+
+class ServerStats:
+    STATUS_CODES = (
+        OK, PARTIAL_CONTENT, NOT_MODIFIED, BAD_REQUEST, FORBIDDEN, NOT_FOUND, NOT_ALLOWED,
+        RANGE_NOT_SATISFIABLE, HEADER_TOO_LARGE, INTERNAL_SERVER_ERROR, SERVICE_UNAVAILABLE,
+    )
+    LATENCY_BUCKETS_COUNT = 28
+    PID, REQUESTS, BYTES, CONNECTIONS = range(4)
+    STATUS_OFFSET = 4
+    LATENCY_OFFSET = STATUS_OFFSET + len(STATUS_CODES) + 1
+    SLOT_SIZE = LATENCY_OFFSET + LATENCY_BUCKETS_COUNT
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self, workers_count):
+        # Every generation of workers gets its own half, so a reload never shares a slot with a retiring worker
+        self.slots_count = 2 * workers_count
+        self.counters = multiprocessing.RawArray('q', self.slots_count * self.SLOT_SIZE)
+        self.status_index = {code: i for i, code in enumerate(self.STATUS_CODES)}
+        self.offset = None
+        self.lock = threading.Lock()
+
+    def attach(self, slot):
+        self.offset = slot * self.SLOT_SIZE
+        self.counters[self.offset + self.PID] = os.getpid()
+        self.counters[self.offset + self.CONNECTIONS] = 0
+
+    def record(self, status, size, latency):
+        if self.offset is None:
+            return
+        counters = self.counters
+        offset = self.offset
+        status_index = self.status_index.get(status, len(self.STATUS_CODES))
+        bucket = min(int(latency * 1e6).bit_length(), self.LATENCY_BUCKETS_COUNT - 1)
+        with self.lock:
+            counters[offset + self.REQUESTS] += 1
+            counters[offset + self.BYTES] += size
+            counters[offset + self.STATUS_OFFSET + status_index] += 1
+            counters[offset + self.LATENCY_OFFSET + bucket] += 1
+
+    def connection_opened(self):
+        if self.offset is not None:
+            with self.lock:
+                self.counters[self.offset + self.CONNECTIONS] += 1
+
+    def connection_closed(self):
+        if self.offset is not None:
+            with self.lock:
+                self.counters[self.offset + self.CONNECTIONS] -= 1
+
+    def connections_count(self):
+        return sum(self.counters[slot * self.SLOT_SIZE + self.CONNECTIONS] for slot in range(self.slots_count))
+
+    def idle_workers(self):
+        """Count workers of the attached generation that have no open connection"""
+        workers = self.slots_count // 2
+        first = self.offset // self.SLOT_SIZE // workers * workers
+        return sum(
+            1 for slot in range(first, first + workers)
+            if self.counters[slot * self.SLOT_SIZE + self.PID] and not self.counters[slot * self.SLOT_SIZE + self.CONNECTIONS]
+        )
+
+    def reset_connections(self, slot):
+        self.counters[slot * self.SLOT_SIZE + self.CONNECTIONS] = 0
+
+    def snapshot(self):
+        workers = []
+        total = [0] * self.SLOT_SIZE
+        for slot in range(self.slots_count):
+            values = self.counters[slot * self.SLOT_SIZE:(slot + 1) * self.SLOT_SIZE]
+            if not values[self.PID]:
+                continue
+            workers.append(dict(self._summary(values), slot=slot, pid=values[self.PID]))
+            total = [a + b for a, b in zip(total, values)]
+        return {'total': self._summary(total), 'workers': workers}
+
+    def _summary(self, values):
+        status = {
+            str(code): values[self.STATUS_OFFSET + i]
+            for i, code in enumerate(self.STATUS_CODES) if values[self.STATUS_OFFSET + i]
+        }
+        other = values[self.STATUS_OFFSET + len(self.STATUS_CODES)]
+        if other:
+            status['other'] = other
+        latency = values[self.LATENCY_OFFSET:self.LATENCY_OFFSET + self.LATENCY_BUCKETS_COUNT]
+        return {
+            'requests': values[self.REQUESTS],
+            'bytes': values[self.BYTES],
+            'connections': values[self.CONNECTIONS],
+            'status': status,
+            'latency_ms': {'p{}'.format(p): self._percentile(latency, p) for p in self.PERCENTILES},
+        }
+
+    @staticmethod
+    def _percentile(buckets, percent):
+        threshold = sum(buckets) * percent / 100
+        seen = 0
+        for bucket, count in enumerate(buckets):
+            seen += count
+            if count and seen >= threshold:
+                return 2 ** bucket / 1000
+        return 0
+
+
+class SamplingProfiler:
+    INTERVAL = 0.01
+    MAX_DEPTH = 128
+
+    def __init__(self, directory='.', interval=INTERVAL, all_threads=False):
+        self.directory = directory
+        self.interval = interval
+        self.all_threads = all_threads
+        self.samples = collections.Counter()
+        self.running = False
+
+    def install(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.signal(signal.SIGUSR1, self.toggle)
+        signal.signal(signal.SIGUSR2, self.dump)
+
+    def toggle(self, *args):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        self.samples.clear()
+        self.running = True
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        logging.info('Profiler started in worker {}'.format(os.getpid()))
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        self.running = False
+        logging.info('Profiler stopped in worker {}'.format(os.getpid()))
+
+    def dump(self, *args):
+        path = os.path.join(self.directory, 'profile-{}.collapsed'.format(os.getpid()))
+        with open(path + '.tmp', 'w') as fd:
+            for stack, count in self.samples.items():
+                fd.write('{} {}\n'.format(';'.join(self._frame_name(code) for code in reversed(stack)), count))
+        os.replace(path + '.tmp', path)
+        logging.info('Profile with {} samples saved to {}'.format(sum(self.samples.values()), path))
+
+    def _sample(self, signum, frame):
+        self._add(frame)
+        if self.all_threads:
+            main_thread = threading.main_thread().ident
+            for ident, thread_frame in sys._current_frames().items():
+                if ident != main_thread:
+                    self._add(thread_frame)
+
+    def _add(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.MAX_DEPTH:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        self.samples[tuple(stack)] += 1
+
+    @staticmethod
+    def _frame_name(code):
+        return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class RequestRecord:
+    def __init__(self, address, http_request, status, size, started, streams=()):
+        self.address = address
+        self.http_request = http_request
+        self.status = status
+        self.body_size = size
+        self.started = started
+        self.streams = streams
+
+    @property
+    def size(self):
+        return self.body_size + sum(stream.size for stream in self.streams)
+
+
+class AccessLog:
+    BUFFER_SIZE = 64 * 1024
+    MAX_BUFFER_SIZE = 16 * 1024 * 1024
+    FLUSH_INTERVAL = 1
+    ESCAPE_TABLE = {code: '\\x{:02X}'.format(code) for code in [*range(0x20), ord('"'), ord('\\'), 0x7f]}
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.lines = []
+        self.size = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+        self.time_cache = (0, '')
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+        os.close(self.fd)
+
+    def write(self, record, request_time):
+        line = self._format(record, request_time).encode('utf-8', 'backslashreplace')
+        with self.lock:
+            if self.size >= self.MAX_BUFFER_SIZE:
+                self.dropped += 1
+                return
+            self.lines.append(line)
+            self.size += len(line)
+            full = self.size >= self.BUFFER_SIZE
+        if full:
+            self.wakeup.set()
+
+    def _format(self, record, request_time):
+        http_request = record.http_request
+        if http_request is not None:
+            request_line = '{} {} {}'.format(http_request.method, http_request.target, http_request.version)
+            referer = http_request.headers.get('referer', '-')
+            user_agent = http_request.headers.get('user-agent', '-')
+        else:
+            request_line = referer = user_agent = '-'
+        return '{} -  - [{}] "{}" {} {} "{}" "{}" "-" "-" "-" {:.3f}\n'.format(
+            record.address[0] if record.address else '-', self._time_local(),
+            request_line.translate(self.ESCAPE_TABLE), record.status, record.size,
+            referer.translate(self.ESCAPE_TABLE), user_agent.translate(self.ESCAPE_TABLE), request_time
+        )
+
+    def _time_local(self):
+        now = int(time.time())
+        if self.time_cache[0] != now:
+            self.time_cache = (now, time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(now)))
+        return self.time_cache[1]
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        with self.lock:
+            lines, self.lines, self.size = self.lines, [], 0
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            logging.error('Access log buffer is full, dropped {} lines'.format(dropped))
+        data = memoryview(b''.join(lines))
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError as e:
+            logging.error('Access log write failed: {}'.format(e))
+
+
+class RequestParseError(Exception):
+    def __init__(self, code, message=''):
+        super().__init__(message)
+        self.code = code
+
+
+class HttpRequest:
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+
+    @property
+    def content_length(self):
+        value = self.headers.get('content-length', '0')
+        # int() also takes a sign and '_', only plain decimal is valid here
+        if not (value.isascii() and value.isdigit()):
+            raise RequestParseError(BAD_REQUEST, 'Invalid Content-Length')
+        return int(value)
+
+    def is_keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+
+class RequestParser:
+    DELIMETER = b'\r\n\r\n'
+    MAX_HEADER_SIZE = 8192
+    MAX_HEADERS_COUNT = 100
+    MAX_DISCARD_BODY_SIZE = 64 * 1024
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE):
+        self.max_header_size = max_header_size
+        self.buffer = bytearray()
+        self.scan_from = 0
+        self.discard = 0
+
+    def feed(self, data):
+        if self.discard:
+            skipped = min(self.discard, len(data))
+            self.discard -= skipped
+            data = data[skipped:]
+        self.buffer += data
+
+    def next_request(self):
+        end = self.buffer.find(self.DELIMETER, self.scan_from)
+        if end == -1:
+            if len(self.buffer) > self.max_header_size:
+                raise RequestParseError(HEADER_TOO_LARGE, 'Request header is too large')
+            self.scan_from = max(0, len(self.buffer) - len(self.DELIMETER) + 1)
+            return None
+        if end > self.max_header_size:
+            raise RequestParseError(HEADER_TOO_LARGE, 'Request header is too large')
+
+        head = bytes(self.buffer[:end])
+        del self.buffer[:end + len(self.DELIMETER)]
+        self.scan_from = 0
+        http_request = self._parse(head)
+
+        content_length = http_request.content_length
+        if content_length:
+            skipped = min(content_length, len(self.buffer))
+            del self.buffer[:skipped]
+            self.discard = content_length - skipped
+        return http_request
+
+    def _parse(self, head):
+        request_line, *header_lines = head.split(b'\r\n')
+        try:
+            method, target, version = request_line.decode('utf-8').split(' ')
+        except (UnicodeDecodeError, ValueError):
+            raise RequestParseError(BAD_REQUEST, 'Invalid request line')
+        if not version.startswith('HTTP/'):
+            raise RequestParseError(BAD_REQUEST, 'Invalid protocol version')
+        if len(header_lines) > self.MAX_HEADERS_COUNT:
+            raise RequestParseError(HEADER_TOO_LARGE, 'Too many headers')
+
+        headers = {}
+        for line in header_lines:
+            name, sep, value = line.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            if not sep or not name:
+                raise RequestParseError(BAD_REQUEST, 'Invalid header line')
+            value = value.strip()
+            headers[name] = '{}, {}'.format(headers[name], value) if name in headers else value
+        return HttpRequest(method, target, version, headers)
+
+
+@functools.lru_cache(maxsize=4096)
+def resolve_path(path_string):
+    path_unquoted = parse.unquote(path_string)
+    path_wo_args = path_unquoted.split('?', 1)[0]
+    # normpath of an absolute path never climbs above '/', a relative one like ../etc/passwd would leave the root
+    if not path_wo_args.startswith('/'):
+        raise ValueError('Request target is not an absolute path: {}'.format(path_string))
+    if path_wo_args.endswith('/'):
+        path_wo_args += 'index.html'
+    path = os.path.normpath(path_wo_args)
+    return os.path.join(DOCUMENT_ROOT, *path.split('/'))
+
+
+_date_cache = [0, b'']
+
+
+def date_header():
+    now = int(time.time())
+    if _date_cache[0] != now:
+        _date_cache[0] = now
+        _date_cache[1] = 'Date: {}\r\n'.format(datetime.fromtimestamp(now).strftime('%d-%m-%Y %H:%M:%S')).encode()
+    return _date_cache[1]
 
 
 class RequestHandler:
     AVAILABLE_METHODS = ['GET', 'HEAD']
-    RECV_STEP_SIZE = 10
-    DELIMETER = b'\r\n\r\n'
+    RECV_BUFFER_SIZE = 65536
+    KEEP_ALIVE_TIMEOUT = 5
+    HEADER_TIMEOUT = 10
+    BODY_TIMEOUT = 10
+    WRITE_TIMEOUT = 30
+    MIN_SEND_RATE = 8 * 1024
+    KEEP_ALIVE_MAX_REQUESTS = 100
+    IDLE_YIELD_GRACE = 0.02
+    MAX_RANGES_COUNT = 16
+    STREAM_FILE_AGE = 2
+    KEEP_ALIVE_HEADER = 'Connection: keep-alive\r\nKeep-Alive: timeout={}, max={}\r\n'.format(
+        KEEP_ALIVE_TIMEOUT, KEEP_ALIVE_MAX_REQUESTS
+    ).encode()
+    CLOSE_HEADER = b'Connection: close\r\n'
+    SERVER_HEADER = b'Server: Otus-http-server\r\n'
+    STATUS_PATH = '/server-status'
 
-    def __init__(self, sock):
+    def __init__(self, sock, server, address=None):
         self.sock = sock
+        self.server = server
+        self.address = address
+        self.keep_alive = False
+        self.yield_connection = False
+        self.http_request = None
+        self.status = None
+        self.started = None
         self.headers = []
-        self.body = ''
-
-    def _read_request(self):
-        buffer = b''
-        result_size = 0
-        while len(buffer) >= result_size:
-            r = self.sock.recv(self.RECV_STEP_SIZE)
-            if not r:
-                raise Exception('Connection close')
-            buffer += r
-            if self.DELIMETER in buffer:
-                break
-            result_size += self.RECV_STEP_SIZE
-        return buffer.decode('utf-8')
+        self.body = []
+
+    def _read_request(self, parser, recv_buffer, deadline, yield_idle=False):
+        http_request = parser.next_request()
+        while http_request is None:
+            now = time.monotonic()
+            timeout = deadline.update(now) - now
+            if timeout <= 0:
+                raise socket.timeout('Read deadline exceeded')
+            if yield_idle and deadline.phase == ReadDeadline.IDLE:
+                self.yield_connection = self._wait_idle(timeout)
+            self.sock.settimeout(timeout)
+            size = self.sock.recv_into(recv_buffer)
+            if not size:
+                raise ConnectionError('Connection close')
+            parser.feed(recv_buffer[:size])
+            http_request = parser.next_request()
+        deadline.reset()
+        return http_request
+
+    def _wait_idle(self, timeout):
+        """Wait for the next keep-alive request, return True when the connection has to be given up after it
+
+        A queued client is left to a free worker. Only when there is none this worker yields: it gives the idle
+        connection a short grace period, answers a request that comes in meanwhile with Connection: close and
+        otherwise closes the connection, unless another worker has accepted the queued client in the meantime.
+        """
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        poller.register(self.server.sock, select.POLLIN)
+        deadline = time.monotonic() + timeout
+        while True:
+            events = dict(poller.poll(max(deadline - time.monotonic(), 0) * 1000))
+            if not events:
+                raise socket.timeout('Read deadline exceeded')
+            if self.sock.fileno() in events:
+                return False
+            # Wait on the client alone while a free worker accepts the queued client or the grace period runs out
+            idle_workers = self._idle_workers()
+            grace = self.IDLE_YIELD_GRACE * (1 if idle_workers else random.uniform(1, 2))
+            if select.select([self.sock], [], [], min(grace, max(deadline - time.monotonic(), 0)))[0]:
+                return not idle_workers
+            if not idle_workers and self.server.sock.fileno() in dict(poller.poll(0)) and not self._idle_workers():
+                raise ConnectionError('Idle connection yields to a queued one')
+
+    def _idle_workers(self):
+        stats = self.server.stats
+        return stats.idle_workers() if stats is not None and stats.offset is not None else 0
 
     def handle_request(self):
+        parser = RequestParser(self.server.max_header_size)
+        deadline = ReadDeadline(parser)
+        recv_buffer = memoryview(bytearray(self.RECV_BUFFER_SIZE))
         try:
-            data = self._read_request()
-        except:
-            return
+            for requests_count in range(1, self.KEEP_ALIVE_MAX_REQUESTS + 1):
+                try:
+                    http_request = self._read_request(parser, recv_buffer, deadline,
+                                                      requests_count > 1 and self.server.YIELD_IDLE_CONNECTIONS)
+                except RequestParseError as e:
+                    self.process_error(e.code)
+                except OSError:
+                    break
+                else:
+                    self.try_process_request(http_request, requests_count)
+
+                record = self.get_record()
+                try:
+                    self.send_response()
+                except OSError:
+                    break
+                self.server.on_response(record)
+                if not self.keep_alive or not self.server.running:
+                    break
+        finally:
+            self.sock.close()
 
+    def try_process_request(self, http_request, requests_count=1):
+        """Process request, answer 500 instead of dropping the connection when the handler fails"""
         try:
-            method = data.split(' ')[0]
-        except Exception:
-            self.create_headers(BAD_REQUEST)
-            self.send_response()
-            return
-        if method not in self.AVAILABLE_METHODS:
+            self.process_request(http_request, requests_count)
+        except Exception as e:
+            logging.exception('Unexpected error on {}: {}'.format(self.address, e))
+            self.close_body()
+            self.process_error(INTERNAL_SERVER_ERROR)
+
+    def close_body(self):
+        for part in self.body:
+            if isinstance(part, (FileSegment, ChunkedBody)):
+                part.close()
+
+    def process_error(self, code):
+        self.headers = []
+        self.body = []
+        self.http_request = None
+        self.started = time.monotonic()
+        self.keep_alive = False
+        self.create_headers(code)
+
+    def process_request(self, http_request, requests_count=1):
+        self.headers = []
+        self.body = []
+        self.http_request = http_request
+        self.started = time.monotonic()
+        self.keep_alive = (
+            self.server.running
+            and not self.yield_connection
+            and http_request.is_keep_alive()
+            and requests_count < self.KEEP_ALIVE_MAX_REQUESTS
+            and http_request.content_length <= RequestParser.MAX_DISCARD_BODY_SIZE
+            and 'transfer-encoding' not in http_request.headers
+        )
+        if http_request.method not in self.AVAILABLE_METHODS:
             self.create_headers(NOT_ALLOWED)
-            self.send_response()
+            return
+        if self.server.stats is not None and http_request.target.split('?', 1)[0] == self.STATUS_PATH:
+            self._create_status_response(http_request)
             return
         try:
-            path_string = data.split(' ')[1]
-            path = self._parse_path(path_string)
-            if method == 'GET':
-                with open(path, 'rb') as rd:
-                    self.body = rd.read()
-            self.create_headers(OK, path)
-        except (FileNotFoundError, NotADirectoryError):
+            file = self.server.file_cache.get(resolve_path(http_request.target))
+        except PermissionError:
+            self.create_headers(FORBIDDEN)
+            return
+        except OSError:
+            # Not found, not a directory, name too long, symlink loop and the like
             self.create_headers(NOT_FOUND)
-        self.send_response()
-
-    def _parse_path(self, path_string):
-        path_unquoted = parse.unquote(path_string)
-        path_wo_args = path_unquoted.split('?', 1)[0]
-        if path_wo_args.endswith('/'):
-            path_wo_args += 'index.html'
-        path = os.path.normpath(path_wo_args)
-        return os.path.join(DOCUMENT_ROOT, *path.split('/'))
-
-    def create_headers(self, code, path=''):
-        if code == OK:
-            self.headers.append(f'HTTP/1.1 {OK} OK\r\n')
-            self.headers.append('Date: {}\r\n'.format(datetime.now().strftime('%d-%m-%Y %H:%M:%S')))
-            self.headers.append('Content-Length: {}\r\n'.format(os.path.getsize(path)))
-            self.headers.append('Content-Type: {}\r\n'.format(mimetypes.guess_type(request.pathname2url(path))[0]))
-        elif code == NOT_FOUND:
-            self.headers.append(f'HTTP/1.1 {NOT_FOUND} Not Found\r\n')
-        elif code == NOT_ALLOWED:
-            self.headers.append(f'HTTP/1.1 {NOT_ALLOWED} ERROR\r\n')
-        elif code == BAD_REQUEST:
-            self.headers.append(f'HTTP/1.1 {BAD_REQUEST} BAD REQUEST\r\n')
-        elif code == FORBIDDEN:
-            self.headers.append(f'HTTP/1.1 {FORBIDDEN} FORBIDDEN\r\n')
-
-        self.headers.append('Server: Otus-http-server\r\n')
-        self.headers.append('\r\n')
+            return
+        except ValueError:
+            self.create_headers(BAD_REQUEST)
+            return
+        variant = None
+        try:
+            if file.source_etag is None and time.time_ns() - file.mtime < self.STREAM_FILE_AGE * 10 ** 9:
+                chunks = read_chunks(file.path, self.server.chunk_size)
+                self.create_stream(OK, chunks, file.type_header, b'Cache-Control: no-cache\r\n')
+                return
+            if self.server.gzip_cache is not None and self._accepts_gzip(http_request):
+                variant = self.server.gzip_cache.get(file)
+            if variant is not None and variant.size < file.size:
+                self._create_file_response(http_request, variant)
+            else:
+                self._create_file_response(http_request, file)
+        finally:
+            file.release()
+            if variant is not None:
+                variant.release()
+
+    def _create_file_response(self, http_request, file):
+        if self._is_not_modified(http_request, file):
+            self.create_headers(NOT_MODIFIED, file)
+            return
+        if http_request.method == 'HEAD':
+            self.create_headers(OK, file, file.type_header, file.length_header)
+            return
+
+        ranges = self._get_ranges(http_request, file)
+        if ranges is None:
+            self.body.append(file.slice(0, file.size))
+            self.create_headers(OK, file, file.type_header, file.length_header)
+        elif not ranges:
+            self.create_headers(
+                RANGE_NOT_SATISFIABLE, file,
+                'Content-Range: bytes */{}\r\n'.format(file.size).encode(), b'Content-Length: 0\r\n'
+            )
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.body.append(file.slice(start, end - start + 1))
+            self.create_headers(
+                PARTIAL_CONTENT, file, file.type_header,
+                'Content-Range: bytes {}-{}/{}\r\n'.format(start, end, file.size).encode(),
+                'Content-Length: {}\r\n'.format(end - start + 1).encode()
+            )
+        else:
+            self._create_multipart_response(file, ranges)
+
+    @staticmethod
+    def _accepts_gzip(http_request):
+        for coding in http_request.headers.get('accept-encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip().lower() not in ('gzip', '*'):
+                continue
+            param, _, value = params.partition('=')
+            if param.strip().lower() != 'q':
+                return True
+            try:
+                return float(value) > 0
+            except ValueError:
+                return False
+        return False
+
+    @staticmethod
+    def _is_not_modified(http_request, file):
+        if_none_match = http_request.headers.get('if-none-match')
+        if if_none_match is not None:
+            etags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in etags or file.etag in etags or 'W/' + file.etag in etags
+        if_modified_since = http_request.headers.get('if-modified-since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return file.mtime // 10 ** 9 <= since
+        return False
+
+    def _get_ranges(self, http_request, file):
+        range_header = http_request.headers.get('range')
+        if range_header is None or not range_header.startswith('bytes='):
+            return None
+        if_range = http_request.headers.get('if-range')
+        if if_range is not None and if_range not in (file.etag, file.last_modified):
+            return None
+
+        ranges = []
+        specs = range_header[len('bytes='):].split(',')
+        if len(specs) > self.MAX_RANGES_COUNT:
+            return None
+        for spec in specs:
+            first, sep, last = spec.strip().partition('-')
+            if not sep or not (first or last) or not (first.isdigit() or not first) \
+                    or not (last.isdigit() or not last):
+                return None
+            if not first:
+                start, end = max(file.size - int(last), 0), file.size - 1
+            else:
+                start = int(first)
+                if last and int(last) < start:
+                    return None
+                end = min(int(last), file.size - 1) if last else file.size - 1
+            if start <= end:
+                ranges.append((start, end))
+        return ranges
+
+    def _create_multipart_response(self, file, ranges):
+        boundary = uuid.uuid4().hex
+        content_length = 0
+        for start, end in ranges:
+            part_header = '\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                boundary, file.mime_type, start, end, file.size
+            ).encode()
+            self.body.append(part_header)
+            self.body.append(file.slice(start, end - start + 1))
+            content_length += len(part_header) + end - start + 1
+        closing = '\r\n--{}--\r\n'.format(boundary).encode()
+        self.body.append(closing)
+        content_length += len(closing)
+        self.create_headers(
+            PARTIAL_CONTENT, file,
+            'Content-Type: multipart/byteranges; boundary={}\r\n'.format(boundary).encode(),
+            'Content-Length: {}\r\n'.format(content_length).encode()
+        )
+
+    def _create_status_response(self, http_request):
+        data = json.dumps(self.server.stats.snapshot(), indent=2).encode()
+        if http_request.method == 'GET':
+            self.body.append(data)
+        self.create_headers(
+            OK, None, b'Content-Type: application/json\r\n', b'Cache-Control: no-cache\r\n',
+            'Content-Length: {}\r\n'.format(len(data)).encode()
+        )
+
+    def create_stream(self, code, chunks, *extra_headers):
+        chunked = self.http_request.version == 'HTTP/1.1'
+        if not chunked:
+            self.keep_alive = False
+        body = ChunkedBody(chunks, chunked)
+        if self.http_request.method == 'HEAD':
+            body.close()
+        else:
+            self.body.append(body)
+        self.create_headers(code, None, *extra_headers, b'Transfer-Encoding: chunked\r\n' if chunked else b'')
+
+    def create_headers(self, code, file=None, *extra_headers):
+        self.status = code
+        self.headers.append(STATUS_LINES[code])
+        self.headers.append(date_header())
+        if file is not None:
+            self.headers.append(file.header)
+        elif not extra_headers:
+            self.headers.append(b'Content-Length: 0\r\n')
+        self.headers.extend(extra_headers)
+        self.headers.append(self.KEEP_ALIVE_HEADER if self.keep_alive else self.CLOSE_HEADER)
+        self.headers.append(self.SERVER_HEADER)
+        self.headers.append(b'\r\n')
+
+    def get_response(self):
+        return [b''.join(self.headers)] + self.body
+
+    def get_record(self):
+        size = 0
+        streams = []
+        for part in self.body:
+            if isinstance(part, FileSegment):
+                size += part.count
+            elif isinstance(part, ChunkedBody):
+                streams.append(part)
+            else:
+                size += len(part)
+        return RequestRecord(self.address, self.http_request, self.status, size, self.started, streams)
 
     def send_response(self):
-        response = ''.join(self.headers).encode('utf-8')
-        if self.body:
-            response += self.body
-        self.sock.sendall(response)
+        header, *body = self.get_response()
+        body = [part for part in body if isinstance(part, (FileSegment, ChunkedBody)) or len(part)]
+        self.sock.settimeout(self.WRITE_TIMEOUT)
+        try:
+            self.sock.sendall(header, MSG_MORE if body else 0)
+            for part in body:
+                if isinstance(part, FileSegment):
+                    part.sendall(self.sock)
+                elif isinstance(part, ChunkedBody):
+                    for frame in part:
+                        self.sock.sendall(frame, 0 if part.done else MSG_MORE)
+                else:
+                    part = memoryview(part)
+                    for offset in range(0, len(part), FileSegment.CHUNK_SIZE):
+                        self.sock.sendall(part[offset:offset + FileSegment.CHUNK_SIZE])
+        finally:
+            for part in body:
+                if isinstance(part, (FileSegment, ChunkedBody)):
+                    part.close()
+
+
+class ReadDeadline:
+    IDLE, HEADER, BODY = range(3)
+    TIMEOUTS = {
+        IDLE: RequestHandler.KEEP_ALIVE_TIMEOUT,
+        HEADER: RequestHandler.HEADER_TIMEOUT,
+        BODY: RequestHandler.BODY_TIMEOUT,
+    }
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.phase = None
+        self.expires = None
+
+    def reset(self):
+        self.phase = None
+
+    def update(self, now):
+        if self.parser.discard:
+            phase = self.BODY
+        elif self.parser.buffer:
+            phase = self.HEADER
+        else:
+            phase = self.IDLE
+        if phase != self.phase:
+            self.phase = phase
+            self.expires = now + self.TIMEOUTS[phase]
+        return self.expires
+
+
+class Connection:
+    COALESCE_SIZE = 16 * 1024
+
+    def __init__(self, sock, address, parser):
+        self.sock = sock
+        self.address = address
+        self.parser = parser
+        self.deadline = ReadDeadline(parser)
+        self.output = collections.deque()
+        self.sent = 0
+        self.requests_count = 0
+        self.closing = False
+        self.last_active = time.monotonic()
+        self.events = selectors.EVENT_READ
+        self.deadline.update(self.last_active)
+
+    def has_pending_output(self):
+        return bool(self.output)
+
+    def push(self, parts):
+        for part in parts:
+            if isinstance(part, (FileSegment, ChunkedBody, RequestRecord)) or len(part) > self.COALESCE_SIZE:
+                self.output.append(part)
+            elif self.output and isinstance(self.output[-1], bytearray):
+                self.output[-1] += part
+            else:
+                self.output.append(bytearray(part))
+
+    def flush(self, on_response):
+        try:
+            while self.output:
+                part = self.output[0]
+                if isinstance(part, RequestRecord):
+                    on_response(part)
+                elif isinstance(part, FileSegment):
+                    if not part.send(self.sock):
+                        return
+                    part.close()
+                elif isinstance(part, ChunkedBody):
+                    frame = part.next_frame()
+                    if frame is not None:
+                        self.output.appendleft(frame)
+                        continue
+                else:
+                    following = self.output[1] if len(self.output) > 1 else None
+                    more = following is not None and not isinstance(following, RequestRecord) \
+                        and not (isinstance(following, ChunkedBody) and following.done)
+                    flags = MSG_MORE if more else 0
+                    self.sent += self.sock.send(memoryview(part)[self.sent:], flags)
+                    if self.sent < len(part):
+                        return
+                    self.sent = 0
+                self.output.popleft()
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def close(self):
+        for part in self.output:
+            if isinstance(part, (FileSegment, ChunkedBody)):
+                part.close()
+        self.output.clear()
         self.sock.close()
 
 
 class HttpServer:
     DEFAULT_LISTEN_BACKLOG = 10
+    ACCEPT_TIMEOUT = 1
+    GRACEFUL_TIMEOUT = 10
+    # One connection per process: an idle keep-alive connection must not hold back queued clients
+    YIELD_IDLE_CONNECTIONS = True
+
+    MAX_CONNECTIONS = 4096
+    CHUNK_SIZE = 64 * 1024
+    PROFILE_ALL_THREADS = False
 
-    def __init__(self, hostname='localhost', port=80):
+    def __init__(self, hostname='localhost', port=80, max_header_size=RequestParser.MAX_HEADER_SIZE,
+                 reuse_port=False, use_gzip=True, max_connections=MAX_CONNECTIONS, access_log=None,
+                 profile_dir='.', chunk_size=CHUNK_SIZE):
         self.hostname = hostname
         self.port = port
-        self.sock = self._init_sock()
+        self.max_header_size = max_header_size
+        self.reuse_port = reuse_port
+        self.max_connections = max_connections
+        self.running = True
+        self.sock = None if reuse_port else self._init_sock()
+        self.stats = None
+        self.file_cache = FileCache()
+        self.gzip_cache = GzipCache() if use_gzip else None
+        self.access_log = AccessLog(access_log) if access_log else None
+        self.chunk_size = chunk_size
+        self.profiler = SamplingProfiler(profile_dir, all_threads=self.PROFILE_ALL_THREADS)
 
     def _init_sock(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind((self.hostname, self.port))
         sock.listen(self.DEFAULT_LISTEN_BACKLOG)
         logging.info('Server start')
 
         return sock
 
-    def serve_forever(self):
+    def _init_worker(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.profiler.install()
+        if self.sock is None:
+            self.sock = self._init_sock()
+        if self.access_log is not None:
+            self.access_log.open()
         logging.info('Start worker: {}'.format(os.getpid()))
+
+    def _close_worker(self):
+        if self.profiler.running:
+            self.profiler.stop()
+        if self.access_log is not None:
+            self.access_log.close()
+        logging.info('Stop worker: {}'.format(os.getpid()))
+
+    def stop(self, *args):
+        self.running = False
+
+    def on_response(self, record):
+        request_time = time.monotonic() - record.started
+        if self.stats is not None:
+            self.stats.record(record.status, record.size, request_time)
+        if self.access_log is not None:
+            self.access_log.write(record, request_time)
+
+    def _overload_response(self):
+        if self.stats is None or self.stats.connections_count() < self.max_connections:
+            return None
+        handler = RequestHandler(None, self)
+        handler.process_error(SERVICE_UNAVAILABLE)
+        self.on_response(handler.get_record())
+        return b''.join(handler.get_response())
+
+    def _reject_overload(self, sock):
+        response = self._overload_response()
+        if response is None:
+            return False
+        try:
+            sock.setblocking(False)
+            sock.send(response)
+        except OSError:
+            pass
+        sock.close()
+        return True
+
+    def _handle_connection(self, sock, address):
+        if self._reject_overload(sock):
+            return
+        if self.stats is not None:
+            self.stats.connection_opened()
+        try:
+            RequestHandler(sock, self, address).handle_request()
+        except Exception as e:
+            logging.exception('Unexpected error on {}: {}'.format(address, e))
+        finally:
+            if self.stats is not None:
+                self.stats.connection_closed()
+
+    def serve_forever(self):
+        self._init_worker()
+        self.sock.settimeout(self.ACCEPT_TIMEOUT)
+        while self.running:
+            try:
+                sock, address = self.sock.accept()
+            except socket.timeout:
+                continue
+            self._handle_connection(sock, address)
+
+        if self.reuse_port:
+            self._drain_accept_queue()
+        self.sock.close()
+        self._close_worker()
+
+    def _drain_accept_queue(self):
+        self.sock.setblocking(False)
         while True:
+            try:
+                sock, address = self.sock.accept()
+            except OSError:
+                return
+            sock.setblocking(True)
+            self._handle_connection(sock, address)
+
+
+class EventLoopHttpServer(HttpServer):
+    DEFAULT_LISTEN_BACKLOG = 1024
+    ACCEPT_BATCH_SIZE = 64
+    SELECT_TIMEOUT = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recv_buffer = memoryview(bytearray(RequestHandler.RECV_BUFFER_SIZE))
+        self.selector = None
+        self.connections = {}
+        self.next_idle_check = 0
+
+    def serve_forever(self):
+        self._init_worker()
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        while self.running:
+            self._poll()
+
+        self.selector.unregister(self.sock)
+        if self.reuse_port:
+            self._accept()
+        self.sock.close()
+        deadline = time.monotonic() + self.GRACEFUL_TIMEOUT
+        while self.connections and time.monotonic() < deadline:
+            for conn in list(self.connections.values()):
+                if conn.requests_count and not conn.has_pending_output() and not conn.parser.buffer:
+                    self._close(conn)
+            self._poll()
+        for conn in list(self.connections.values()):
+            self._close(conn)
+        self._close_worker()
+
+    def _poll(self):
+        for key, mask in self.selector.select(self.SELECT_TIMEOUT):
+            if key.data is None:
+                self._accept()
+                continue
+            conn = key.data
+            try:
+                if mask & selectors.EVENT_READ:
+                    self._on_read(conn)
+                if mask & selectors.EVENT_WRITE:
+                    self._on_write(conn)
+            except OSError:
+                self._close(conn)
+            except Exception as e:
+                logging.exception('Unexpected error on {}: {}'.format(conn.address, e))
+                self._close(conn)
+        self._close_idle()
+
+    def _accept(self):
+        for _ in range(self.ACCEPT_BATCH_SIZE):
+            try:
+                sock, address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.error('Accept failed: {}'.format(e))
+                return
+            if self._reject_overload(sock):
+                continue
+            sock.setblocking(False)
+            conn = Connection(sock, address, RequestParser(self.max_header_size))
+            self.connections[sock.fileno()] = conn
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+            if self.stats is not None:
+                self.stats.connection_opened()
+
+    def _on_read(self, conn):
+        if conn.closing:
+            return
+        size = conn.sock.recv_into(self.recv_buffer)
+        if not size:
+            self._close(conn)
+            return
+        conn.parser.feed(self.recv_buffer[:size])
+
+        handler = RequestHandler(conn.sock, self, conn.address)
+        while not conn.closing:
+            try:
+                http_request = conn.parser.next_request()
+            except RequestParseError as e:
+                handler.process_error(e.code)
+            else:
+                if http_request is None:
+                    break
+                conn.deadline.reset()
+                conn.requests_count += 1
+                handler.try_process_request(http_request, conn.requests_count)
+            conn.push(handler.get_response())
+            conn.push([handler.get_record()])
+            conn.closing = not handler.keep_alive
+
+        if conn.has_pending_output():
+            self._on_write(conn)
+        else:
+            conn.deadline.update(time.monotonic())
+
+    def _on_write(self, conn):
+        if conn.has_pending_output():
+            conn.flush(self.on_response)
+            conn.last_active = time.monotonic()
+            if not conn.has_pending_output():
+                conn.deadline.update(conn.last_active)
+
+        if conn.has_pending_output():
+            if conn.closing:
+                self._set_events(conn, selectors.EVENT_WRITE)
+            else:
+                self._set_events(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            return
+        if conn.closing:
+            self._close(conn)
+        else:
+            self._set_events(conn, selectors.EVENT_READ)
+
+    def _set_events(self, conn, events):
+        if conn.events != events:
+            self.selector.modify(conn.sock, events, conn)
+            conn.events = events
+
+    def _close_idle(self):
+        now = time.monotonic()
+        if now < self.next_idle_check:
+            return
+        self.next_idle_check = now + self.SELECT_TIMEOUT
+        write_deadline = now - RequestHandler.WRITE_TIMEOUT
+        for conn in list(self.connections.values()):
+            if conn.has_pending_output():
+                expired = conn.last_active < write_deadline
+            else:
+                expired = conn.deadline.update(now) <= now
+            if expired:
+                self._close(conn)
+
+    def _close(self, conn):
+        if conn.sock.fileno() == -1:
+            return
+        if self.stats is not None:
+            self.stats.connection_closed()
+        self.connections.pop(conn.sock.fileno(), None)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
+
+
+class ThreadPoolHttpServer(HttpServer):
+    DEFAULT_LISTEN_BACKLOG = 1024
+    PROFILE_ALL_THREADS = True
+    THREADS_COUNT = 16
+    YIELD_IDLE_CONNECTIONS = False
+
+    def __init__(self, *args, threads_count=THREADS_COUNT, queue_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threads_count = threads_count
+        self.queue_size = queue_size if queue_size is not None else threads_count
+
+    def serve_forever(self):
+        self._init_worker()
+        self.sock.settimeout(self.ACCEPT_TIMEOUT)
+        connections = queue.Queue(self.queue_size)
+        with ThreadPoolExecutor(self.threads_count) as executor:
+            for _ in range(self.threads_count):
+                executor.submit(self._run_thread, connections)
+            while self.running:
+                self._accept(connections)
+            if self.reuse_port:
+                self.sock.setblocking(False)
+                while self._accept(connections):
+                    pass
+            self.sock.close()
+            for _ in range(self.threads_count):
+                connections.put(None)
+        self._close_worker()
+
+    def _accept(self, connections):
+        try:
             sock, address = self.sock.accept()
-            handler = RequestHandler(sock)
-            handler.handle_request()
+        except OSError:
+            return False
+        if not self._reject_overload(sock):
+            sock.setblocking(True)
+            connections.put((sock, address))
+        return True
+
+    def _run_thread(self, connections):
+        while True:
+            connection = connections.get()
+            if connection is None:
+                return
+            try:
+                self._handle_connection(*connection)
+            except Exception:
+                logging.exception('Unexpected error')
+
+
+class AsyncioHttpServer(HttpServer):
+    DEFAULT_LISTEN_BACKLOG = 1024
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = {}
+        self.stopped = None
+
+    def serve_forever(self):
+        self._init_worker()
+        loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._serve())
+        finally:
+            loop.close()
+        self._close_worker()
+
+    def stop(self, *args):
+        super().stop()
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def _serve(self):
+        self.stopped = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stop)
+        self.sock.setblocking(False)
+        server = await asyncio.start_server(
+            self._handle_client, sock=self.sock, backlog=self.DEFAULT_LISTEN_BACKLOG,
+            limit=RequestHandler.RECV_BUFFER_SIZE
+        )
+        await self.stopped.wait()
+
+        server.close()
+        for task, idle in list(self.connections.items()):
+            if idle:
+                task.cancel()
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=self.GRACEFUL_TIMEOUT)
+        for task in list(self.connections):
+            task.cancel()
+        if self.connections:
+            await asyncio.wait(list(self.connections))
+
+    async def _handle_client(self, reader, writer):
+        response = self._overload_response()
+        if response is not None:
+            writer.write(response)
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self.connections[task] = True
+        if self.stats is not None:
+            self.stats.connection_opened()
+        parser = RequestParser(self.max_header_size)
+        deadline = ReadDeadline(parser)
+        handler = RequestHandler(None, self, writer.get_extra_info('peername'))
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            for requests_count in range(1, RequestHandler.KEEP_ALIVE_MAX_REQUESTS + 1):
+                self.connections[task] = not parser.buffer
+                try:
+                    http_request = await self._read_request(reader, parser, deadline)
+                except RequestParseError as e:
+                    handler.process_error(e.code)
+                else:
+                    if http_request is None:
+                        break
+                    handler.try_process_request(http_request, requests_count)
+                self.connections[task] = False
+
+                record = handler.get_record()
+                await self._send_response(writer, handler.get_response())
+                self.on_response(record)
+                if not handler.keep_alive or not self.running:
+                    break
+        except (OSError, asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        finally:
+            handler.close_body()
+            writer.close()
+            del self.connections[task]
+            if self.stats is not None:
+                self.stats.connection_closed()
+
+    @staticmethod
+    async def _read_request(reader, parser, deadline):
+        http_request = parser.next_request()
+        while http_request is None:
+            now = time.monotonic()
+            data = await asyncio.wait_for(reader.read(RequestHandler.RECV_BUFFER_SIZE), deadline.update(now) - now)
+            if not data:
+                return None
+            parser.feed(data)
+            http_request = parser.next_request()
+        deadline.reset()
+        return http_request
+
+    async def _send_response(self, writer, parts):
+        pending = bytearray()
+        for part in parts:
+            if not isinstance(part, (FileSegment, ChunkedBody)) and len(part) <= Connection.COALESCE_SIZE:
+                pending += part
+                continue
+            if pending:
+                writer.write(pending)
+                pending = bytearray()
+            if isinstance(part, FileSegment):
+                await asyncio.wait_for(writer.drain(), RequestHandler.WRITE_TIMEOUT)
+                await self._send_file(writer, part)
+                continue
+            if isinstance(part, ChunkedBody):
+                for frame in part:
+                    writer.write(frame)
+                    await self._drain(writer)
+                continue
+            part = memoryview(part)
+            for offset in range(0, len(part), FileSegment.CHUNK_SIZE):
+                writer.write(part[offset:offset + FileSegment.CHUNK_SIZE])
+                await self._drain(writer)
+        if pending:
+            writer.write(pending)
+        await self._drain(writer)
+
+    @staticmethod
+    async def _drain(writer):
+        if writer.transport.get_write_buffer_size() > FileSegment.CHUNK_SIZE:
+            await asyncio.wait_for(writer.drain(), RequestHandler.WRITE_TIMEOUT)
+
+    async def _send_file(self, writer, segment):
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                await asyncio.wait_for(
+                    loop.sendfile(writer.transport, segment.file.file, segment.offset, segment.count,
+                                  fallback=False),
+                    RequestHandler.WRITE_TIMEOUT + segment.count / RequestHandler.MIN_SEND_RATE
+                )
+                return
+            except (AttributeError, NotImplementedError, asyncio.SendfileNotAvailableError):
+                pass
+            while segment.count:
+                data = await loop.run_in_executor(
+                    None, os.pread, segment.file.fileno(), min(segment.count, FileSegment.CHUNK_SIZE),
+                    segment.offset
+                )
+                if not data:
+                    raise ConnectionError('File truncated')
+                writer.write(data)
+                await self._drain(writer)
+                segment.offset += len(data)
+                segment.count -= len(data)
+        finally:
+            segment.close()
+
+
+class Master:
+    CHECK_INTERVAL = 1
+    RESTART_DELAY = 1
+
+    def __init__(self, server, workers_count, cpu_affinity=False):
+        self.server = server
+        self.server.stats = ServerStats(workers_count)
+        self.workers_count = workers_count
+        self.cpu_affinity = cpu_affinity
+        self.workers = {}
+        self.retiring = []
+        self.restarts = {}
+        self.running = True
+        self.reload_requested = False
+        self.generation = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        signal.signal(signal.SIGUSR1, self.dump_status)
+        signal.signal(signal.SIGUSR2, self.dump_profiles)
+        for slot in range(self.workers_count):
+            self._spawn(slot)
+
+        while self.running:
+            if self.reload_requested:
+                self._reload()
+            self._restart_scheduled()
+            processes = list(self.workers.values()) + self.retiring
+            multiprocessing.connection.wait([p.sentinel for p in processes], self.CHECK_INTERVAL)
+            self._reap()
+        self._shutdown()
+
+    def stop(self, *args):
+        self.running = False
+
+    def reload(self, *args):
+        self.reload_requested = True
+
+    def dump_status(self, *args):
+        logging.info('Server status: {}'.format(json.dumps(self.server.stats.snapshot())))
+
+    def dump_profiles(self, *args):
+        for p in self.workers.values():
+            os.kill(p.pid, signal.SIGUSR2)
+
+    def _spawn(self, slot):
+        stats_slot = self.generation % 2 * self.workers_count + slot
+        p = Process(target=self._run_worker, args=(slot, stats_slot))
+        p.daemon = True
+        p.start()
+        p.started_at = time.monotonic()
+        p.stats_slot = stats_slot
+        self.workers[slot] = p
+
+    def _run_worker(self, slot, stats_slot):
+        if self.cpu_affinity:
+            cpus = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(0, {cpus[slot % len(cpus)]})
+        self.server.stats.attach(stats_slot)
+        self.server.serve_forever()
+
+    def _reap(self):
+        for slot, p in list(self.workers.items()):
+            if p.is_alive():
+                continue
+            p.join()
+            del self.workers[slot]
+            self.server.stats.reset_connections(p.stats_slot)
+            logging.error('Worker {} exited with code {}'.format(p.pid, p.exitcode))
+            if time.monotonic() - p.started_at < self.RESTART_DELAY:
+                self.restarts[slot] = time.monotonic() + self.RESTART_DELAY
+            else:
+                self._spawn(slot)
+        for p in list(self.retiring):
+            if not p.is_alive():
+                p.join()
+                self.retiring.remove(p)
+                self.server.stats.reset_connections(p.stats_slot)
+            elif time.monotonic() - p.retired_at > self.server.GRACEFUL_TIMEOUT:
+                p.kill()
+
+    def _restart_scheduled(self):
+        now = time.monotonic()
+        for slot, restart_at in list(self.restarts.items()):
+            if restart_at <= now:
+                del self.restarts[slot]
+                self._spawn(slot)
+
+    def _reload(self):
+        self.reload_requested = False
+        self.restarts.clear()
+        logging.info('Reload workers')
+        # Workers left from the previous reload still hold the stats slots of the new generation
+        for p in self.retiring:
+            p.kill()
+            p.join()
+            self.server.stats.reset_connections(p.stats_slot)
+        self.retiring.clear()
+        self.generation += 1
+        old_workers = list(self.workers.values())
+        for slot in range(self.workers_count):
+            self._spawn(slot)
+        for p in old_workers:
+            self._retire(p)
+
+    def _retire(self, p):
+        p.retired_at = time.monotonic()
+        self.retiring.append(p)
+        if p.is_alive():
+            logging.info('Stop worker: {}'.format(p.pid))
+            p.terminate()
+
+    def _shutdown(self):
+        for p in self.workers.values():
+            self._retire(p)
+        self.workers.clear()
+        while self.retiring:
+            multiprocessing.connection.wait([p.sentinel for p in self.retiring], self.CHECK_INTERVAL)
+            self._reap()
+
+
+SERVERS = {
+    'sync': HttpServer,
+    'event': EventLoopHttpServer,
+    'thread': ThreadPoolHttpServer,
+    'asyncio': AsyncioHttpServer,
+}
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-w', help='Number of workers', default=4)
+    parser.add_argument('-p', help='Port', type=int, default=80)
+    parser.add_argument('-m', help='Worker mode', choices=SERVERS.keys(), default='sync')
     parser.add_argument('-r', help='document root', default=os.path.abspath(os.path.dirname(__file__)))
+    parser.add_argument('--max-header-size', help='Max request header size in bytes', type=int,
+                        default=RequestParser.MAX_HEADER_SIZE)
+    parser.add_argument('--reuse-port', help='Bind a SO_REUSEPORT socket in every worker', action='store_true')
+    parser.add_argument('--no-gzip', help='Disable gzip compression', action='store_true')
+    parser.add_argument('--cpu-affinity', help='Pin every worker to its own CPU', action='store_true')
+    parser.add_argument('--max-connections', help='Max open connections for all workers, extra ones get 503',
+                        type=int, default=HttpServer.MAX_CONNECTIONS)
+    parser.add_argument('--access-log', help='Access log path, nginx combined format with request time')
+    parser.add_argument('--profile-dir', help='Directory for worker profiles', default='.')
+    parser.add_argument('--chunk-size', help='Chunk size in bytes for streamed responses', type=int,
+                        default=HttpServer.CHUNK_SIZE)
+    parser.add_argument('-t', help='Number of threads per worker in thread mode', type=int,
+                        default=ThreadPoolHttpServer.THREADS_COUNT)
+    parser.add_argument('--queue-size', help='Accepted connections queue size per worker in thread mode', type=int)
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -136,22 +1807,20 @@ if __name__ == '__main__':
 
     DOCUMENT_ROOT = os.path.abspath(args.r)
 
-    server = HttpServer(
+    kwargs = dict(
         hostname=os.environ.get('HOSTNAME'),
+        port=args.p,
+        max_header_size=args.max_header_size,
+        reuse_port=args.reuse_port,
+        use_gzip=not args.no_gzip,
+        max_connections=args.max_connections,
+        access_log=args.access_log,
+        profile_dir=args.profile_dir,
+        chunk_size=args.chunk_size,
     )
+    if args.m == 'thread':
+        kwargs.update(threads_count=args.t, queue_size=args.queue_size)
+    server = SERVERS[args.m](**kwargs)
 
-    process_list = []
-    for _ in range(int(args.w)):
-        p = Process(target=server.serve_forever)
-        p.daemon = True
-        p.start()
-        process_list.append(p)
-
-    try:
-        for p in process_list:
-            p.join()
-    except KeyboardInterrupt:
-        for p in process_list:
-            if p.is_alive():
-                logging.info('Stop worker: {}'.format(p.pid))
-                p.terminate()
+    master = Master(server, int(args.w), cpu_affinity=args.cpu_affinity)
+    master.run()
@@ -0,0 +1,16 @@
+import unittest
+
+from tests.test_parser import RequestParserTest
+from tests.test_ranges import RangesTest
+
+
+def suite():
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(RequestParserTest))
+    test_suite.addTest(unittest.makeSuite(RangesTest))
+    return test_suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,97 @@
+from unittest import TestCase
+
+from httpd import BAD_REQUEST, HEADER_TOO_LARGE, RequestParseError, RequestParser
+
+REQUEST = b'GET /index.html HTTP/1.1\r\nHost: localhost\r\nAccept: */*\r\n\r\n'
+
+
+class RequestParserTest(TestCase):
+
+    def setUp(self):
+        self.parser = RequestParser()
+
+    def parse(self, *parts):
+        requests = []
+        for part in parts:
+            self.parser.feed(part)
+            http_request = self.parser.next_request()
+            while http_request is not None:
+                requests.append(http_request)
+                http_request = self.parser.next_request()
+        return requests
+
+    def assertParseError(self, code, *parts):
+        with self.assertRaises(RequestParseError) as context:
+            self.parse(*parts)
+        self.assertEqual(context.exception.code, code)
+
+    def test_request(self):
+        http_request, = self.parse(REQUEST)
+        self.assertEqual((http_request.method, http_request.target, http_request.version),
+                         ('GET', '/index.html', 'HTTP/1.1'))
+        self.assertEqual(http_request.headers, {'host': 'localhost', 'accept': '*/*'})
+        self.assertFalse(self.parser.buffer)
+
+    def test_delimiter_resumes_across_feeds(self):
+        for cut in range(len(REQUEST) - 4, len(REQUEST)):
+            with self.subTest(cut=cut):
+                self.parser = RequestParser()
+                self.parser.feed(REQUEST[:cut])
+                self.assertIsNone(self.parser.next_request())
+                self.parser.feed(REQUEST[cut:])
+                self.assertEqual(self.parser.next_request().target, '/index.html')
+
+    def test_byte_by_byte(self):
+        requests = self.parse(*(REQUEST[pos:pos + 1] for pos in range(len(REQUEST))))
+        self.assertEqual([http_request.target for http_request in requests], ['/index.html'])
+
+    def test_pipelined_requests(self):
+        second = REQUEST.replace(b'/index.html', b'/second.html')
+        requests = self.parse(REQUEST + second[:10], second[10:])
+        self.assertEqual([http_request.target for http_request in requests], ['/index.html', '/second.html'])
+
+    def test_repeated_header_is_joined(self):
+        http_request, = self.parse(b'GET / HTTP/1.1\r\nAccept: a\r\nACCEPT:b \r\n\r\n')
+        self.assertEqual(http_request.headers['accept'], 'a, b')
+
+    def test_body_discarded_before_pipelined_request(self):
+        post = b'POST /form HTTP/1.1\r\nContent-Length: 10\r\n\r\n'
+        requests = self.parse(post + b'0123', b'456', b'789' + REQUEST)
+        self.assertEqual([http_request.target for http_request in requests], ['/form', '/index.html'])
+        self.assertFalse(self.parser.buffer)
+        self.assertEqual(self.parser.discard, 0)
+
+    def test_body_in_same_feed_is_discarded(self):
+        requests = self.parse(b'POST /form HTTP/1.1\r\nContent-Length: 5\r\n\r\n\r\n\r\n!' + REQUEST)
+        self.assertEqual([http_request.target for http_request in requests], ['/form', '/index.html'])
+
+    def test_header_too_large_without_delimiter(self):
+        self.parser = RequestParser(max_header_size=64)
+        self.assertEqual(self.parse(b'GET / HTTP/1.1\r\n', b'X: ' + b'x' * 40), [])
+        self.assertParseError(HEADER_TOO_LARGE, b'x' * 10)
+
+    def test_header_too_large_with_delimiter(self):
+        self.parser = RequestParser(max_header_size=64)
+        self.assertParseError(HEADER_TOO_LARGE, b'GET / HTTP/1.1\r\nX: ' + b'x' * 64 + b'\r\n\r\n')
+
+    def test_too_many_headers(self):
+        headers = b''.join(b'X-%d: 1\r\n' % n for n in range(RequestParser.MAX_HEADERS_COUNT + 1))
+        self.assertParseError(HEADER_TOO_LARGE, b'GET / HTTP/1.1\r\n' + headers + b'\r\n')
+
+    def test_bad_requests(self):
+        for head in (b'GET /\r\n\r\n', b'GET  / HTTP/1.1\r\n\r\n', b'GET /\xff HTTP/1.1\r\n\r\n',
+                     b'GET / FTP/1.0\r\n\r\n', b'GET / HTTP/1.1\r\nHost\r\n\r\n',
+                     b'GET / HTTP/1.1\r\n: x\r\n\r\n', b'POST / HTTP/1.1\r\nContent-Length: +5\r\n\r\n',
+                     b'POST / HTTP/1.1\r\nContent-Length: 1_0\r\n\r\n'):
+            with self.subTest(head=head):
+                self.parser = RequestParser()
+                self.assertParseError(BAD_REQUEST, head)
+
+    def test_keep_alive(self):
+        for version, connection, expected in (('HTTP/1.1', None, True), ('HTTP/1.1', 'Close', False),
+                                              ('HTTP/1.0', None, False), ('HTTP/1.0', 'keep-alive', True)):
+            with self.subTest(version=version, connection=connection):
+                header = 'Connection: {}\r\n'.format(connection) if connection else ''
+                self.parser = RequestParser()
+                http_request, = self.parse('GET / {}\r\n{}\r\n'.format(version, header).encode())
+                self.assertEqual(http_request.is_keep_alive(), expected)
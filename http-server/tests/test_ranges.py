@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from httpd import PARTIAL_CONTENT, RANGE_NOT_SATISFIABLE, FileCache, RequestHandler, RequestParser
+
+DATA = bytes(range(100))
+
+
+class RangesTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix='httpd-test-')
+        path = os.path.join(cls.dir, 'data.bin')
+        with open(path, 'wb') as fd:
+            fd.write(DATA)
+        cls.file = FileCache().get(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.file.release()
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        self.handler = RequestHandler(None, None)
+
+    def request(self, **headers):
+        head = 'GET /data.bin HTTP/1.1\r\n' + ''.join(
+            '{}: {}\r\n'.format(name.replace('_', '-'), value) for name, value in headers.items()
+        )
+        parser = RequestParser()
+        parser.feed((head + '\r\n').encode())
+        return parser.next_request()
+
+    def get_ranges(self, range_header, **headers):
+        return self.handler._get_ranges(self.request(range=range_header, **headers), self.file)
+
+    def respond(self, range_header):
+        self.handler._create_file_response(self.request(range=range_header), self.file)
+        header, *body = self.handler.get_response()
+        return header.decode(), b''.join(bytes(part) for part in body)
+
+    def test_no_range(self):
+        self.assertIsNone(self.handler._get_ranges(self.request(), self.file))
+        self.assertIsNone(self.get_ranges('items=0-1'))
+
+    def test_single_ranges(self):
+        for range_header, expected in (('bytes=0-9', (0, 9)), ('bytes=90-500', (90, 99)), ('bytes=95-', (95, 99)),
+                                       ('bytes=-10', (90, 99)), ('bytes=-500', (0, 99)), ('bytes= 7-7 ', (7, 7))):
+            with self.subTest(range=range_header):
+                self.assertEqual(self.get_ranges(range_header), [expected])
+
+    def test_multiple_ranges(self):
+        self.assertEqual(self.get_ranges('bytes=0-1, 5-6,-2'), [(0, 1), (5, 6), (98, 99)])
+        self.assertEqual(self.get_ranges('bytes=0-1,200-300'), [(0, 1)])
+
+    def test_unsatisfiable_ranges(self):
+        for range_header in ('bytes=100-', 'bytes=200-300', 'bytes=-0', 'bytes=100-,200-'):
+            with self.subTest(range=range_header):
+                self.assertEqual(self.get_ranges(range_header), [])
+
+    def test_invalid_ranges_are_ignored(self):
+        too_many = 'bytes=' + ','.join('{0}-{0}'.format(n) for n in range(RequestHandler.MAX_RANGES_COUNT + 1))
+        for range_header in ('bytes=5-1', 'bytes=-', 'bytes=1', 'bytes=a-b', 'bytes=+1-2', 'bytes=0-1,', too_many):
+            with self.subTest(range=range_header):
+                self.assertIsNone(self.get_ranges(range_header))
+
+    def test_if_range(self):
+        self.assertEqual(self.get_ranges('bytes=0-9', if_range=self.file.etag), [(0, 9)])
+        self.assertEqual(self.get_ranges('bytes=0-9', if_range=self.file.last_modified), [(0, 9)])
+        self.assertIsNone(self.get_ranges('bytes=0-9', if_range='"stale"'))
+        self.assertIsNone(self.get_ranges('bytes=0-9', if_range='W/' + self.file.etag))
+
+    def test_single_range_response(self):
+        header, body = self.respond('bytes=-10')
+        self.assertEqual(self.handler.status, PARTIAL_CONTENT)
+        self.assertIn('Content-Range: bytes 90-99/100\r\n', header)
+        self.assertIn('Content-Length: 10\r\n', header)
+        self.assertEqual(body, DATA[90:])
+
+    def test_not_satisfiable_response(self):
+        header, body = self.respond('bytes=100-')
+        self.assertEqual(self.handler.status, RANGE_NOT_SATISFIABLE)
+        self.assertIn('Content-Range: bytes */100\r\n', header)
+        self.assertIn('Content-Length: 0\r\n', header)
+        self.assertEqual(body, b'')
+
+    def test_multipart_response(self):
+        header, body = self.respond('bytes=0-1,95-')
+        self.assertEqual(self.handler.status, PARTIAL_CONTENT)
+        boundary = header.split('boundary=', 1)[1].split('\r\n', 1)[0]
+        self.assertIn('Content-Length: {}\r\n'.format(len(body)), header)
+        parts = body.split('\r\n--{}'.format(boundary).encode())
+        self.assertEqual(parts[0], b'')
+        self.assertEqual(parts[-1], b'--\r\n')
+        self.assertEqual([part.split(b'\r\n\r\n', 1) for part in parts[1:-1]], [
+            [b'\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes 0-1/100', DATA[:2]],
+            [b'\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes 95-99/100', DATA[95:]],
+        ])